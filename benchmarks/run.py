@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+""" time the uhcsdb hot paths against a synthetic dataset and emit json
+
+python benchmarks/synthetic.py --scale 100k --out bench-data
+python benchmarks/run.py --data bench-data --output results.json
+python benchmarks/run.py --data bench-data --baseline results.json  # flag regressions
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.append('.')
+
+FEATURES = os.path.join('representations', 'synthetic-vlad.h5')
+
+def timed(fn, repeat=1):
+    """ run fn repeat times; summary statistics in seconds.
+
+    responses (anything with a status_code) must be 200, so error pages
+    are never timed as results.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+        status = getattr(result, 'status_code', None)
+        if status is not None and status != 200:
+            raise AssertionError('expected status 200, got {}'.format(status))
+    times = np.array(times)
+    return dict(min=float(times.min()), median=float(np.median(times)),
+                mean=float(times.mean()), p99=float(np.percentile(times, 99)), n=len(times))
+
+def bench_features(data, n_queries, rng):
+    from uhcsdb import features
+
+    featuresfile = os.path.join(data, FEATURES)
+    results = {}
+    results['load_features'] = timed(lambda: features.load_features(featuresfile))
+
+    storedir = tempfile.mkdtemp(prefix='uhcsdb-store-')
+    try:
+        results['convert_features'] = timed(
+            lambda: features.convert_features(featuresfile, storedir=storedir))
+        results['load_feature_store'] = timed(
+            lambda: features.load_feature_store(featuresfile, storedir=storedir), repeat=5)
+    finally:
+        shutil.rmtree(storedir)
+
+    results['build_search_tree'] = timed(
+        lambda: features.build_search_tree(os.path.dirname(featuresfile),
+                                           featurename=os.path.basename(featuresfile)))
+
+    ids = rng.choice(features.index.keys, size=min(n_queries, len(features.index)), replace=False)
+    ids = iter(ids.tolist())
+    results['query'] = timed(lambda: features.query(next(ids)), repeat=min(n_queries, len(features.index)))
+    return results
+
+def configure_app(data):
+    """ point the flask app at the synthetic dataset; must run before importing uhcsdb """
+    settings = os.path.join(tempfile.mkdtemp(prefix='uhcsdb-settings-'), 'settings.py')
+    with open(settings, 'w') as f:
+        f.write('DATABASE = {!r}\n'.format(os.path.join(data, 'microstructures.sqlite')))
+        f.write('REPRESENTATION_PATH = {!r}\n'.format(os.path.join(data, 'representations')))
+        f.write('REPRESENTATION = {!r}\n'.format(os.path.basename(FEATURES)))
+        f.write('INDEX_PATH = {!r}\n'.format(os.path.join(data, 'index')))
+        f.write('PUBLICATIONS_WATCH_INTERVAL = 0\n')
+        f.write('INDEX_WATCH_INTERVAL = 0\n')
+        f.write('RESPONSE_CACHE_SIZE = 0\n')
+    os.environ['UHCSDB_SETTINGS'] = settings
+
+def bench_routes(data, n_requests, rng):
+    """ time routes through the flask test client """
+    from uhcsdb import app, features
+    from uhcsdb.uhcsdb import index_warmup
+
+    # workers warm up from a prebuilt index; build it first so the warm-up
+    # loads it instead of fitting one in the background while routes are timed
+    results = {}
+    results['build_index'] = timed(
+        lambda: features.build_index(os.path.join(data, FEATURES), app.config['INDEX_PATH'],
+                                     backend=app.config['SEARCH_BACKEND'] or 'brute',
+                                     backend_params=app.config['SEARCH_BACKEND_PARAMS']))
+
+    client = app.test_client()
+    results['first_request'] = timed(lambda: client.get('/entries/1'))
+    results['index_warmup'] = timed(index_warmup.wait)
+    if index_warmup.state != 'ready':
+        raise RuntimeError('index warm-up failed: {}'.format(index_warmup.status()))
+
+    n_pages = max(1, len(features.index) // 24)
+    pages = iter(rng.randint(1, n_pages + 1, size=n_requests).tolist())
+    results['entries'] = timed(lambda: client.get('/entries/{}'.format(next(pages))), repeat=n_requests)
+
+    ids = iter(rng.choice(features.index.keys, size=n_requests).tolist())
+    results['show_entry'] = timed(lambda: client.get('/micrograph/{}'.format(next(ids))), repeat=n_requests)
+
+    ids = iter(rng.choice(features.index.keys, size=n_requests).tolist())
+    results['visual_query'] = timed(lambda: client.get('/visual_query/{}'.format(next(ids))), repeat=n_requests)
+    return results
+
+def environment():
+    import sklearn
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                sklearn=sklearn.__version__, machine=platform.machine(),
+                processor=platform.processor(), commit=commit)
+
+def compare(report, baseline, tolerance):
+    """ list timings whose median slowed down by more than tolerance """
+    regressions = []
+    for group in ('features', 'routes'):
+        for name, stats in report.get(group, {}).items():
+            before = baseline.get(group, {}).get(name)
+            if before is None:
+                continue
+            ratio = stats['median'] / max(before['median'], 1e-12)
+            if ratio > 1 + tolerance:
+                regressions.append(dict(timing='{}.{}'.format(group, name),
+                                        baseline=before['median'], current=stats['median'],
+                                        ratio=ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark uhcsdb hot paths')
+    parser.add_argument('--data', default='bench-data', help='directory from benchmarks/synthetic.py')
+    parser.add_argument('--queries', type=int, default=1000, help='number of features.query calls')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the json report here (default stdout)')
+    parser.add_argument('--baseline', help='earlier json report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional slowdown before a timing counts as a regression')
+    args = parser.parse_args(argv)
+
+    rng = np.random.RandomState(args.seed)
+    configure_app(args.data)
+
+    report = dict(
+        data=os.path.abspath(args.data),
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        environment=environment(),
+        features=bench_features(args.data, args.queries, rng),
+        routes=bench_routes(args.data, args.requests, rng),
+    )
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if report.get('regressions'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
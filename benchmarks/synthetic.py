@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+""" generate a synthetic uhcsdb dataset for benchmarking
+
+python benchmarks/synthetic.py --scale 100k --out bench-data
+
+writes, under --out:
+  microstructures.sqlite                     catalog for the tables in uhcsdb/models.py
+  representations/synthetic-vlad.h5          one feature vector dataset per micrograph
+  embed/synthetic-tsne.h5                    2-d map points in a perplexity-N group
+"""
+import os
+import sys
+import argparse
+import h5py
+import numpy as np
+from sqlalchemy import create_engine
+
+sys.path.append('.')
+from uhcsdb.models import Base, User, Sample, Micrograph
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000}
+
+LABELS = ['spheroidite', 'spheroidite+widmanstatten', 'martensite', 'network',
+          'pearlite', 'pearlite+spheroidite', 'pearlite+widmanstatten']
+COOL_METHODS = ['Q', 'AR', 'FC', '650-1H']
+DETECTORS = ['SE', 'BSE']
+
+def parse_scale(scale):
+    return SCALES.get(scale.lower()) or int(scale)
+
+def write_features(path, n, n_features, n_clusters, rng, chunk=10000):
+    """ clustered gaussian feature vectors, one hdf5 dataset per micrograph id """
+    centers = rng.normal(size=(n_clusters, n_features)).astype(np.float32)
+    with h5py.File(path, 'w') as f:
+        for start in range(0, n, chunk):
+            stop = min(start + chunk, n)
+            assignments = rng.randint(n_clusters, size=stop - start)
+            X = centers[assignments] + 0.5 * rng.normal(size=(stop - start, n_features)).astype(np.float32)
+            for offset, x in enumerate(X):
+                f.create_dataset(str(start + offset + 1), data=x)
+
+def write_tsne(path, n, rng, perplexity=40):
+    """ 2-d map points grouped under perplexity-N, as load_features expects for t-SNE files """
+    with h5py.File(path, 'w') as f:
+        g = f.create_group('perplexity-{}'.format(perplexity))
+        X = rng.normal(size=(n, 2)) * 30
+        for key, x in enumerate(X, 1):
+            g.create_dataset(str(key), data=x)
+
+def write_catalog(path, n, rng, n_samples=None, chunk=50000):
+    """ users, samples and micrographs with plausible metadata distributions """
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+
+    n_samples = n_samples or max(1, n // 40)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            dict(user_id=1, username='synthetic', email='bench@example.com')
+        ])
+        samples = []
+        for sample_id in range(1, n_samples + 1):
+            temperature = float(rng.choice([700, 750, 800, 900, 970, 1100]))
+            time, cool = float(rng.choice([5, 15, 90, 180, 1440])), str(rng.choice(COOL_METHODS))
+            samples.append(dict(
+                sample_id=sample_id,
+                label='{}C {}M {}'.format(int(temperature), int(time), cool),
+                anneal_time=time, anneal_time_unit='M',
+                anneal_temperature=temperature, anneal_temp_unit='C',
+                cool_method=cool))
+        conn.execute(Sample.__table__.insert(), samples)
+
+        for start in range(1, n + 1, chunk):
+            stop = min(start + chunk, n + 1)
+            conn.execute(Micrograph.__table__.insert(), [
+                dict(micrograph_id=m_id,
+                     path='micrograph{}.tif'.format(m_id),
+                     micron_bar=float(rng.choice([1, 5, 10, 20])),
+                     micron_bar_units='um',
+                     micron_bar_px=int(rng.randint(50, 200)),
+                     # stored as text with either case of suffix, like the real catalog
+                     magnification='{}{}'.format(rng.choice([1000, 2000, 4910, 10000]),
+                                                 rng.choice(['x', 'X'])),
+                     detector=str(rng.choice(DETECTORS)),
+                     sample_key=int(rng.randint(1, n_samples + 1)),
+                     contributor_key=1,
+                     primary_microconstituent=str(rng.choice(LABELS)))
+                for m_id in range(start, stop)
+            ])
+
+def generate(out, n, n_features=512, n_clusters=64, seed=0):
+    rng = np.random.RandomState(seed)
+    for sub in ('representations', 'embed'):
+        os.makedirs(os.path.join(out, sub), exist_ok=True)
+
+    write_catalog(os.path.join(out, 'microstructures.sqlite'), n, rng)
+    write_features(os.path.join(out, 'representations', 'synthetic-vlad.h5'),
+                   n, n_features, n_clusters, rng)
+    write_tsne(os.path.join(out, 'embed', 'synthetic-tsne.h5'), n, rng)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='generate a synthetic uhcsdb dataset')
+    parser.add_argument('--scale', default='1k', help='number of micrographs: 1k, 10k, 100k, 1m or an integer')
+    parser.add_argument('--out', default='bench-data', help='output directory')
+    parser.add_argument('--features', type=int, default=512, help='feature vector length')
+    parser.add_argument('--clusters', type=int, default=64, help='number of feature clusters')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    n = parse_scale(args.scale)
+    generate(args.out, n, n_features=args.features, n_clusters=args.clusters, seed=args.seed)
+    print('wrote {} synthetic micrographs to {}'.format(n, args.out))
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,142 @@
 #!/usr/bin/env python
-""" load uhcsdb metadata from sqlite database into pandas dataframe """
+""" export uhcsdb metadata from the sqlite database in bounded memory
+
+python scripts/export_metadata.py                                     # data/uhcs-metadata.csv
+python scripts/export_metadata.py -o metadata.parquet --microconstituent martensite
+python scripts/export_metadata.py -o metadata.arrow --columns micrograph_id,anneal_temperature
+
+rows stream from sqlite in chunks and are written chunk by chunk;
+csv needs only the standard library, parquet and arrow ipc need pyarrow.
+"""
+import os
 import sys
-import numpy as np
-import pandas as pd
-from contextlib import contextmanager
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, contains_eager
+import csv
+import argparse
 
 sys.path.append('.')
-from uhcsdb.models import Base, User, Collection, Sample, Micrograph
-
-@contextmanager
-def uhcsdb_session(dbpath):
-    """ start a sqlalchemy session for the uhcsdb metadata store """
-    engine = create_engine('sqlite:///' + dbpath)
-    Base.metadata.bind = engine
-    dbSession = sessionmaker(bind=engine)
-    db = dbSession()
+from uhcsdb import search
+from uhcsdb.database import session_scope as uhcsdb_session
+
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+def arrow_schema(names):
+    """ arrow types from the model column types """
+    import pyarrow as pa
+    from sqlalchemy import Float, Integer
+
+    lookup = dict(search.COLUMNS)
+    fields = []
+    for name in names:
+        column_type = lookup[name].type
+        # the distributed database stores magnification as text like '4910x'
+        if name == 'magnification':
+            dtype = pa.string()
+        elif isinstance(column_type, Integer):
+            dtype = pa.int64()
+        elif isinstance(column_type, Float):
+            dtype = pa.float64()
+        else:
+            dtype = pa.string()
+        fields.append(pa.field(name, dtype))
+    return pa.schema(fields)
+
+def arrow_column(values, dtype):
+    import pyarrow as pa
+    if dtype == pa.string():
+        values = [None if v is None else str(v) for v in values]
+    return pa.array(values, type=dtype)
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def write_csv(rows, names, path, chunksize):
+    n = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for chunk in chunked(rows, chunksize):
+            writer.writerows(chunk)
+            n += len(chunk)
+    return n
+
+def write_arrow(rows, names, path, chunksize, fmt):
+    import pyarrow as pa
+
+    schema = arrow_schema(names)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+        write = writer.write_table
+        wrap = lambda batch: pa.Table.from_batches([batch])
+    else:
+        sink = pa.OSFile(path, 'wb')
+        writer = pa.ipc.new_file(sink, schema)
+        write = writer.write_batch
+        wrap = lambda batch: batch
+
+    n = 0
     try:
-        yield db
+        for chunk in chunked(rows, chunksize):
+            columns = [arrow_column(values, field.type)
+                       for field, values in zip(schema, zip(*chunk))]
+            write(wrap(pa.RecordBatch.from_arrays(columns, schema=schema)))
+            n += len(chunk)
     finally:
-        db.close()
+        writer.close()
+        if fmt != 'parquet':
+            sink.close()
+    return n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='export uhcsdb micrograph metadata')
+    parser.add_argument('--db', default='uhcsdb/microstructures.sqlite', help='sqlite metadata store')
+    parser.add_argument('-o', '--output', default='data/uhcs-metadata.csv',
+                        help='output file; format follows the extension (.csv, .parquet, .arrow)')
+    parser.add_argument('--format', choices=sorted(set(FORMATS.values())),
+                        help='override the format implied by the extension')
+    parser.add_argument('--columns', help='comma-separated output columns (default: all)')
+    parser.add_argument('--chunksize', type=int, default=10000, help='rows per chunk')
+    for name in search.CATEGORICAL:
+        parser.add_argument('--' + name, action='append', help='keep rows with this {}'.format(name))
+    for name in search.RANGES:
+        for bound in ('min', 'max'):
+            parser.add_argument('--{}_{}'.format(name, bound), help='{} bound for {}'.format(bound, name))
+    args = parser.parse_args(argv)
+
+    fmt = args.format or FORMATS.get(os.path.splitext(args.output)[1].lower())
+    if fmt is None:
+        parser.error('cannot infer the format of {}; pass --format'.format(args.output))
+
+    filter_args = {name: getattr(args, name) for name in search.CATEGORICAL}
+    for name in search.RANGES:
+        for bound in ('min', 'max'):
+            key = '{}_{}'.format(name, bound)
+            filter_args[key] = [getattr(args, key)] if getattr(args, key) is not None else None
+    try:
+        filters = search.parse_filters(filter_args)
+    except ValueError as e:
+        parser.error(str(e))
+    names = args.columns.split(',') if args.columns else search.COLUMN_NAMES
+
+    with uhcsdb_session(args.db) as db:
+        try:
+            q = search.metadata_query(db, filters, names)
+        except ValueError as e:
+            parser.error(str(e))
+        rows = q.yield_per(args.chunksize)
+        if fmt == 'csv':
+            n = write_csv(rows, names, args.output, args.chunksize)
+        else:
+            n = write_arrow(rows, names, args.output, args.chunksize, fmt)
+
+    print('wrote {} rows to {}'.format(n, args.output))
 
 if __name__ == '__main__':
-    
-    with uhcsdb_session('uhcsdb/microstructures.sqlite') as db:
-        
-        # get metadata for all images associated with a sample
-        q = (
-            db.query(Micrograph)
-            .outerjoin(Micrograph.sample)
-            .options(contains_eager(Micrograph.sample))
-        )
-        df = pd.read_sql_query(q.statement, con=db.connection())
-
-    # drop the redundant id field that results from Micrograph.sample.id
-    df = df.T.groupby(level=0).last().T
-
-    print(df.head())
-    df.to_csv('data/uhcs-metadata.csv')
+    main()
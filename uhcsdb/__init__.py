@@ -1 +1,7 @@
-from .uhcsdb import app
+def __getattr__(name):
+    # import the flask app on first access (e.g. gunicorn uhcsdb:app), so the
+    # command line tools can use uhcsdb.models, features, ... without it
+    if name == 'app':
+        from .uhcsdb import app
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,75 @@
+""" in-process cache of rendered responses with strong etags
+
+pages like /visual_query/<id> only change when the dataset or the search index does,
+so rendered bodies are cached on route arguments plus a dataset version.
+"""
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+class ResponseCache(object):
+    """ thread-safe LRU with a maximum entry count and per-entry TTL """
+
+    def __init__(self, max_entries=2048, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def cached_view(cache, version):
+    """ serve a view from cache, with a strong etag and 304 support.
+
+    version() returns a hashable dataset version; changing it invalidates every entry.
+    only 200 responses are cached.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            route = (request.endpoint, tuple(sorted(kwargs.items())), request.query_string)
+            entry = cache.get(route + (version(),))
+            if entry is None:
+                response = current_app.make_response(view(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                entry = (body, response.mimetype, hashlib.sha1(body).hexdigest())
+                # the view may have loaded what version() describes (e.g. a
+                # search index), so file the body under the version it saw
+                cache.put(route + (version(),), entry)
+
+            body, mimetype, etag = entry
+            response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
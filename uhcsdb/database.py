@@ -0,0 +1,128 @@
+""" shared sqlalchemy engine and session management for the uhcsdb metadata store
+
+the flask app, the bokeh explorer (visualize.py) and the scripts all connect through here,
+so each process builds one pooled engine per database file.
+
+python -m uhcsdb.database create-indexes --db uhcsdb/microstructures.sqlite
+"""
+import os
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import Session, scoped_session
+
+# applied to every new sqlite connection
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('mmap_size', 256 * 1024**2),
+    ('cache_size', -64 * 1024),  # negative values are KiB
+)
+
+_engines = {}
+
+def version(dbpath):
+    """ changes whenever the database contents may have.
+
+    under WAL, commits land in <dbpath>-wal and only reach the main file
+    at checkpoints, so both files' mtimes and sizes count.
+    """
+    stats = []
+    for path in (dbpath, dbpath + '-wal'):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stats.append(None)
+            continue
+        stats.append((st.st_mtime_ns, st.st_size))
+    return tuple(stats)
+
+def get_engine(dbpath, pool_size=5, max_overflow=10, pool_timeout=30, pragmas=SQLITE_PRAGMAS):
+    """ return the process-wide engine for a sqlite database file.
+
+    engines are keyed on pid too, so forked workers never share pooled connections.
+    """
+    key = (os.path.abspath(dbpath), os.getpid())
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+
+    engine = create_engine(
+        'sqlite:///' + dbpath,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        connect_args={'check_same_thread': False}
+    )
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            try:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            except sqlite3.Error as e:
+                # WAL needs a writable database directory
+                print('could not set PRAGMA {}: {}'.format(name, e))
+        cursor.close()
+
+    _engines[key] = engine
+    return engine
+
+def connect_db(dbpath, **engine_options):
+    """ return a new session on the shared engine; the caller closes it """
+    return Session(bind=get_engine(dbpath, **engine_options))
+
+@contextmanager
+def session_scope(dbpath, **engine_options):
+    """ a session that is closed (returning its connection to the pool) on exit """
+    db = connect_db(dbpath, **engine_options)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def init_app(app):
+    """ request-scoped sessions for a flask app.
+
+    the session is removed when the app context tears down,
+    returning its connection to the pool.
+    """
+    def make_session():
+        return connect_db(app.config['DATABASE'], **app.config.get('DATABASE_ENGINE_OPTIONS', {}))
+
+    db_session = scoped_session(make_session)
+
+    @app.teardown_appcontext
+    def remove_session(exception=None):
+        db_session.remove()
+
+    return db_session
+
+def indexes(args):
+    """ add the indexes declared in models.py to an existing database, offline """
+    from uhcsdb.models import create_indexes
+    create_indexes(get_engine(args.db))
+    print('indexes up to date in {}'.format(args.db))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='maintain the uhcsdb metadata store')
+    subparsers = parser.add_subparsers(dest='command')
+
+    indexes_parser = subparsers.add_parser(
+        'create-indexes', help='create indexes missing from the distributed database')
+    indexes_parser.add_argument('--db', default='uhcsdb/microstructures.sqlite',
+                                help='sqlite metadata database')
+    indexes_parser.set_defaults(func=indexes)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
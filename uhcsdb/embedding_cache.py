@@ -0,0 +1,80 @@
+""" process-wide cache of reduced-dimensionality map points for the bokeh explorer
+
+the bokeh server runs visualize.py once per session, but imported modules are shared,
+so every session in the process reads embeddings through this one cache.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# memory budget for cached embeddings; override with UHCSDB_EMBEDDING_CACHE_MB
+DEFAULT_CACHE_MB = 256
+
+class EmbeddingCache(object):
+    """ thread-safe LRU cache of numpy arrays bounded by total nbytes """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key, loader):
+        """ return the cached array for key, calling loader() on a miss.
+
+        concurrent misses on the same key only load once.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        with self._key_lock(key):
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+
+            value = loader()
+            self.put(key, value)
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return
+            # cached arrays are shared between sessions
+            value.setflags(write=False)
+            self._entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def prefetch(self, items):
+        """ load (key, loader) pairs in a background thread """
+        def run():
+            for key, loader in items:
+                try:
+                    self.get(key, loader)
+                except Exception as e:
+                    print('could not prefetch {}: {}'.format(key, e))
+
+        thread = threading.Thread(target=run, name='embedding-prefetch')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+embeddings = EmbeddingCache(
+    max_bytes=int(os.environ.get('UHCSDB_EMBEDDING_CACHE_MB', DEFAULT_CACHE_MB)) * 1024**2
+)
@@ -0,0 +1,100 @@
+""" columnar snapshot of the bokeh explorer's metadata
+
+each column is stored as its own .npy file so a new bokeh session memory-maps
+the already-normalized data instead of querying and reshaping it.
+the snapshot is rebuilt whenever microstructures.sqlite changes.
+"""
+import os
+import json
+import numpy as np
+
+from database import session_scope, version
+from models import Micrograph, Sample
+
+SNAPSHOT_VERSION = 1
+MISSING = -9999 # bokeh (because json) can't deal with NaN values
+
+def _as_float(values):
+    return np.array([MISSING if v is None else v for v in values], dtype=np.float64)
+
+def build_snapshot(dbpath, snapdir, labels, colors):
+    """ query explorer metadata and write normalized columns to snapdir """
+    # taken before the query, so writes that race it make the snapshot stale
+    db_version = version(dbpath)
+    with session_scope(dbpath) as db:
+        rows = (db.query(Micrograph.micrograph_id,
+                         Micrograph.primary_microconstituent,
+                         Micrograph.micron_bar,
+                         Micrograph.micron_bar_px,
+                         Sample.anneal_temperature,
+                         Sample.anneal_time,
+                         Sample.anneal_time_unit)
+                .outerjoin(Micrograph.sample)
+                .filter(Micrograph.primary_microconstituent.in_(list(labels)))
+                .order_by(Micrograph.micrograph_id)
+                .all())
+
+    (micrograph_id, mclass, micron_bar, micron_bar_px,
+     temperature, time, time_unit) = zip(*rows) if rows else [()] * 7
+
+    micrograph_id = np.array(micrograph_id, dtype=np.int64)
+    mclass = np.array(mclass, dtype=np.str_)
+
+    # convert times to minutes
+    time = _as_float(time)
+    time[np.array([unit == 'H' for unit in time_unit], dtype=bool)] *= 60
+
+    columns = dict(
+        micrograph_id=micrograph_id,
+        primary_microconstituent=mclass,
+        anneal_temperature=_as_float(temperature),
+        anneal_time=time,
+        mag=_as_float(micron_bar) / _as_float(micron_bar_px), # TODO: convert units!
+        thumb=np.array(['static/thumbs/micrograph{}.png'.format(key) for key in micrograph_id],
+                       dtype=np.str_),
+        c=np.array([colors[cls] for cls in mclass], dtype=np.str_),
+    )
+
+    os.makedirs(snapdir, exist_ok=True)
+    for name, column in columns.items():
+        path = os.path.join(snapdir, name + '.npy')
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, column)
+        os.replace(tmp, path)
+
+    # write the metadata last: it marks the snapshot as complete
+    meta = dict(version=SNAPSHOT_VERSION, db_version=db_version,
+                labels=sorted(labels), colors=colors, columns=sorted(columns))
+    path = os.path.join(snapdir, 'meta.json')
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, path)
+
+def snapshot_is_current(dbpath, snapdir, labels, colors):
+    try:
+        with open(os.path.join(snapdir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    # round-trip through json so tuples compare equal to the stored lists
+    db_version = json.loads(json.dumps(version(dbpath)))
+    return (meta.get('version') == SNAPSHOT_VERSION
+            and meta.get('db_version') == db_version
+            and meta['labels'] == sorted(labels) and meta['colors'] == colors)
+
+def load_snapshot(dbpath, labels, colors, snapdir=None):
+    """ memory-map the explorer columns, rebuilding the snapshot if it is stale """
+    if snapdir is None:
+        snapdir = os.path.splitext(dbpath)[0] + '-explorer'
+    colors = {label: colors[label] for label in labels}
+
+    if not snapshot_is_current(dbpath, snapdir, labels, colors):
+        print('building explorer snapshot in {}'.format(snapdir))
+        build_snapshot(dbpath, snapdir, labels, colors)
+
+    with open(os.path.join(snapdir, 'meta.json'), 'r') as f:
+        names = json.load(f)['columns']
+    return {name: np.load(os.path.join(snapdir, name + '.npy'), mmap_mode='r')
+            for name in names}
@@ -1,81 +1,1424 @@
 import os
-import h5py
+import json
+import time
 import pickle
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.neighbors import NearestNeighbors
 
-from flask import current_app
+from uhcsdb import metrics
 
-keys = None
-features = None
-nneighs = None
+# the SearchIndex currently served; replaced wholesale, never mutated
+index = None
+# serializes writers (load, reload); readers never take it
+_index_lock = threading.Lock()
 
 
+def _feature_group(f, featuresfile, perplexity=40):
+    """ t-SNE files hold one group of map points per perplexity value """
+    if 'tsne' in featuresfile:
+        return f['perplexity-{}'.format(perplexity)]
+    return f
+
 def load_features(featuresfile, perplexity=40):
-    keys, X = [], []
-    
+    """ read every feature vector in an hdf5 file into one contiguous array """
+    import h5py
+
     with h5py.File(featuresfile, 'r') as f:
-        
-        if 'tsne' in featuresfile:
-            g = f['perplexity-{}'.format(perplexity)]
-        else:
-            g = f
-            
-        for key in g.keys():
-            xx = g[key][...]
-            keys.append(int(key))
-            X.append(g[key][...])
+        g = _feature_group(f, featuresfile, perplexity)
+        names = list(g.keys())
+        keys = [int(name) for name in names]
 
-    return keys, np.array(X)
+        X = None
+        for row, name in enumerate(names):
+            dset = g[name]
+            if X is None:
+                X = np.empty((len(names),) + dset.shape, dtype=dset.dtype)
+            dset.read_direct(X[row])
+
+    if X is None:
+        X = np.empty((0, 0))
+
+    return keys, X
 
 def reload_features(featuresfile, keys, perplexity=40):
-    X = []
-    
-    with h5py.File(featuresfile, 'r') as f:        
-        if 'tsne' in featuresfile:
-            g = f['perplexity-{}'.format(perplexity)]
+    """ read feature vectors for an explicit key ordering """
+    import h5py
+
+    with h5py.File(featuresfile, 'r') as f:
+        g = _feature_group(f, featuresfile, perplexity)
+
+        X = None
+        for row, key in enumerate(keys):
+            dset = g[str(key)]
+            if X is None:
+                X = np.empty((len(keys),) + dset.shape, dtype=dset.dtype)
+            dset.read_direct(X[row])
+
+    if X is None:
+        X = np.empty((0, 0))
+
+    return X
+
+
+# consolidated feature store:
+# <name>.npy holds the feature matrix, <name>.keys.npy the primary keys,
+# and <name>.json records the hdf5 source file the store was converted from.
+# the matrix is memory-mapped read-only, so gunicorn workers share the
+# same physical pages instead of each holding a private copy.
+STORE_VERSION = 1
+
+def _file_digest(path, blocksize=1<<20):
+    """ sha1 hex digest of a file, read in blocks """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _atomic_save(path, array):
+    """ write an npy file under a temporary name and rename it into place """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+def _atomic_dump(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+def feature_store_path(featuresfile, perplexity=40, storedir=None):
+    """ path prefix for the consolidated copy of an hdf5 features file """
+    name = os.path.splitext(os.path.basename(featuresfile))[0]
+    if 'tsne' in featuresfile:
+        name += '-perplexity-{}'.format(perplexity)
+    if storedir is None:
+        storedir = os.path.join(os.path.dirname(featuresfile), 'store')
+    return os.path.join(storedir, name)
+
+def convert_features(featuresfile, perplexity=40, storedir=None):
+    """ convert an hdf5 features file to the consolidated feature store """
+    prefix = feature_store_path(featuresfile, perplexity, storedir)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+    st = os.stat(featuresfile)
+    keys, X = load_features(featuresfile, perplexity=perplexity)
+    if not np.issubdtype(X.dtype, np.floating):
+        X = X.astype(np.float64)
+
+    _atomic_save(prefix + '.npy', np.ascontiguousarray(X))
+    _atomic_save(prefix + '.keys.npy', np.array(keys, dtype=np.int64))
+
+    # write the metadata last: it marks the store as complete
+    meta = dict(
+        version=STORE_VERSION,
+        source=os.path.abspath(featuresfile),
+        perplexity=perplexity,
+        mtime=st.st_mtime,
+        size=st.st_size,
+        sha1=_file_digest(featuresfile),
+        shape=list(X.shape),
+        dtype=str(X.dtype)
+    )
+    _atomic_dump(prefix + '.json', meta)
+    return prefix
+
+def _store_is_current(prefix, featuresfile):
+    """ check a feature store against the mtime and hash of its source """
+    try:
+        with open(prefix + '.json', 'r') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+
+    if meta.get('version') != STORE_VERSION:
+        return False
+
+    st = os.stat(featuresfile)
+    if meta['mtime'] == st.st_mtime and meta['size'] == st.st_size:
+        return True
+
+    # the source was touched: only rebuild if the contents changed
+    if meta['size'] != st.st_size or meta['sha1'] != _file_digest(featuresfile):
+        return False
+
+    meta['mtime'] = st.st_mtime
+    _atomic_dump(prefix + '.json', meta)
+    return True
+
+def load_feature_store(featuresfile, perplexity=40, storedir=None):
+    """ memory-map features from the consolidated store.
+
+    (re)convert from hdf5 when the store is missing or stale.
+    """
+    prefix = feature_store_path(featuresfile, perplexity, storedir)
+    if not _store_is_current(prefix, featuresfile):
+        print('converting {} to feature store'.format(featuresfile))
+        convert_features(featuresfile, perplexity=perplexity, storedir=storedir)
+
+    keys = np.load(prefix + '.keys.npy').tolist()
+    X = np.load(prefix + '.npy', mmap_mode='r')
+    return keys, X
+
+
+def fit_projection(X, ndim=64, random_state=0):
+    """ fit a PCA basis; the full svd solver keeps the fit deterministic """
+    from sklearn.decomposition import PCA
+    pca = PCA(n_components=ndim, svd_solver='full', random_state=random_state)
+    pca.fit(X)
+    return pca.mean_, pca.components_
+
+def project(X, mean, components):
+    """ project feature vectors onto a stored PCA basis """
+    return np.dot(np.asarray(X) - mean, components.T)
+
+# nearest neighbor backends:
+# each backend follows the sklearn NearestNeighbors interface,
+# fit(X) -> self and kneighbors(Q, n_neighbors) -> (distances, indices),
+# with rows of each result sorted by increasing euclidean distance.
+# backends with supports_mask also accept kneighbors(Q, n_neighbors, mask=...),
+# a boolean array over the fitted rows; rows outside the mask are never
+# returned, and short result lists are padded with -1 (at distance inf).
+
+# filters selecting at most this fraction of an index are searched exactly
+# over just the selected vectors instead of masking the full backend
+EXACT_FILTER_FRACTION = 0.1
+
+def _topk(sqdist, n_neighbors):
+    """ sorted indices and distances of the n smallest entries in each row """
+    n_neighbors = min(n_neighbors, sqdist.shape[1])
+    if n_neighbors < sqdist.shape[1]:
+        idx = np.argpartition(sqdist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    else:
+        idx = np.tile(np.arange(sqdist.shape[1]), (sqdist.shape[0], 1))
+    part = np.take_along_axis(sqdist, idx, axis=1)
+    order = np.argsort(part, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, axis=1)
+    part = np.take_along_axis(part, order, axis=1)
+    return np.sqrt(np.maximum(part, 0)), idx
+
+def _pad_masked(distances, indices):
+    """ mark results that only exist because of masked-out rows """
+    indices[~np.isfinite(distances)] = -1
+    return distances, indices
+
+# tiled exact search: distances are computed for a (rows x cols) tile of
+# queries x vectors at a time and merged into running top-k lists, so
+# temporary memory depends on the tile budget rather than on the index size.
+# bytes per tile entry: float64 distances, the int64 candidate ids and
+# argpartition indices, and one temporary
+_TILE_ENTRY_BYTES = 32
+
+def _tile_shape(n_rows, n_cols, budget_bytes):
+    """ (rows, cols) of a distance tile that fits in budget_bytes """
+    side = max(1, int(np.sqrt(budget_bytes / _TILE_ENTRY_BYTES)))
+    rows = max(1, min(n_rows, side))
+    cols = max(1, min(n_cols, int(budget_bytes // (_TILE_ENTRY_BYTES * rows))))
+    return rows, cols
+
+def _merge_topk(best_d, best_i, sqdist, offset, n_neighbors):
+    """ fold a tile of squared distances for columns offset... into running top-k lists """
+    candidates_d = np.hstack((best_d, sqdist))
+    candidates_i = np.hstack((best_i, np.broadcast_to(
+        np.arange(offset, offset + sqdist.shape[1]), sqdist.shape)))
+    if n_neighbors < candidates_d.shape[1]:
+        keep = np.argpartition(candidates_d, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        candidates_d = np.take_along_axis(candidates_d, keep, axis=1)
+        candidates_i = np.take_along_axis(candidates_i, keep, axis=1)
+    return candidates_d, candidates_i
+
+def _tiled_kneighbors(Q, X, sqnorm, n_neighbors, budget_bytes, excluded=None, self_offset=None):
+    """ exact sorted top-k of Q against X, one bounded tile at a time.
+
+    excluded is a boolean array over the rows of X that may not be returned;
+    with self_offset, query row j is X row self_offset + j and is skipped.
+    unfilled slots are -1 at distance inf.
+    """
+    Q = np.atleast_2d(Q)
+    n = X.shape[0]
+    n_neighbors = min(n_neighbors, n)
+    rows, cols = _tile_shape(Q.shape[0], n, budget_bytes)
+    distances = np.empty((Q.shape[0], n_neighbors))
+    indices = np.empty((Q.shape[0], n_neighbors), dtype=np.int64)
+
+    for r0 in range(0, Q.shape[0], rows):
+        q = np.asarray(Q[r0:r0+rows])
+        qnorm = np.einsum('ij,ij->i', q, q)
+        best_d = np.full((q.shape[0], n_neighbors), np.inf)
+        best_i = np.full((q.shape[0], n_neighbors), -1, dtype=np.int64)
+        for c0 in range(0, n, cols):
+            c1 = min(c0 + cols, n)
+            sqdist = qnorm[:, None] - 2 * np.dot(q, np.asarray(X[c0:c1]).T) + sqnorm[None, c0:c1]
+            if excluded is not None:
+                sqdist[:, excluded[c0:c1]] = np.inf
+            if self_offset is not None:
+                own = self_offset + r0 + np.arange(q.shape[0])
+                inside = (own >= c0) & (own < c1)
+                sqdist[np.flatnonzero(inside), own[inside] - c0] = np.inf
+            best_d, best_i = _merge_topk(best_d, best_i, sqdist, c0, n_neighbors)
+
+        order = np.argsort(best_d, axis=1, kind='stable')
+        distances[r0:r0+q.shape[0]] = np.sqrt(np.maximum(np.take_along_axis(best_d, order, axis=1), 0))
+        indices[r0:r0+q.shape[0]] = np.take_along_axis(best_i, order, axis=1)
+
+    indices[~np.isfinite(distances)] = -1
+    return distances, indices
+
+def _resident_nbytes(*arrays):
+    """ bytes of arrays held in process memory, each buffer counted once.
+
+    memory-mapped arrays (and views of them) are backed by the shared page
+    cache rather than this process, so they are not counted.
+    """
+    counted = []
+    for a in arrays:
+        if a is None:
+            continue
+        base = a
+        while base is not None and not isinstance(base, np.memmap):
+            base = getattr(base, 'base', None)
+        if base is not None or any(np.may_share_memory(a, b) for b in counted):
+            continue
+        counted.append(a)
+    return sum(a.nbytes for a in counted)
+
+# fitted backends are pickled to nneighs.pkl without the vectors (persisted
+# as vectors.npy) or the arrays named in their persisted_arrays, which
+# _write_build saves as nneighs-<name>.npy. load_index memory-maps those and
+# attaches the vectors, so workers share them through the page cache
+# instead of each holding a private unpickled copy.
+def _pickled_state(backend):
+    state = dict(backend.__dict__)
+    for name in ('_X',) + getattr(backend, 'persisted_arrays', ()):
+        state.pop(name, None)
+    return state
+
+def _persisted_array_path(builddir, name):
+    return os.path.join(builddir, 'nneighs-{}.npy'.format(name.strip('_')))
+
+class BruteForceBackend(object):
+    """ exact search, one bounded tile of queries x vectors at a time.
+
+    memory_mb caps the temporary distance tiles, so a large batch or a
+    large index does not allocate a full queries x n distance matrix.
+    """
+
+    supports_mask = True
+    persisted_arrays = ('_sqnorm',)
+
+    def __init__(self, memory_mb=64):
+        self.memory_mb = memory_mb
+
+    def fit(self, X):
+        self._X = X
+        self._sqnorm = np.einsum('ij,ij->i', X, X)
+        return self
+
+    def __getstate__(self):
+        return _pickled_state(self)
+
+    def attach(self, X):
+        self._X = X
+
+    def resident_arrays(self):
+        return (self._X, self._sqnorm)
+
+    def kneighbors(self, Q, n_neighbors=5, mask=None):
+        excluded = None if mask is None else ~np.asarray(mask, dtype=bool)
+        return _tiled_kneighbors(Q, self._X, self._sqnorm, n_neighbors,
+                                 self.memory_mb * 1024**2, excluded=excluded)
+
+class IVFBackend(object):
+    """ approximate search over an inverted file.
+
+    k-means assigns every vector to one of n_lists coarse cells;
+    a query is compared exactly against the vectors in its n_probe nearest cells.
+    """
+
+    supports_mask = True
+    persisted_arrays = ('centroids_', '_order', '_sqnorm', '_offsets')
+
+    def __init__(self, n_lists=None, n_probe=8, random_state=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.random_state = random_state
+
+    def fit(self, X):
+        from sklearn.cluster import MiniBatchKMeans
+        self._X = X
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(X.shape[0])))
+        n_lists = min(n_lists, X.shape[0])
+
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=self.random_state)
+        assignments = kmeans.fit_predict(np.asarray(X))
+        self.centroids_ = kmeans.cluster_centers_
+
+        # cell c holds rows _order[_offsets[c]:_offsets[c+1]]; candidate
+        # vectors are gathered from X, so only row ids are stored per cell
+        self._order = np.argsort(assignments, kind='stable')
+        self._sqnorm = np.einsum('ij,ij->i', X, X)
+        counts = np.bincount(assignments, minlength=n_lists)
+        self._offsets = np.concatenate(([0], np.cumsum(counts)))
+        return self
+
+    def __getstate__(self):
+        return _pickled_state(self)
+
+    def attach(self, X):
+        self._X = X
+
+    def resident_arrays(self):
+        return (self.centroids_, self._order, self._X, self._sqnorm, self._offsets)
+
+    def kneighbors(self, Q, n_neighbors=5, mask=None):
+        Q = np.atleast_2d(Q)
+        allowed = None if mask is None else np.asarray(mask, dtype=bool)
+        n_probe = min(self.n_probe, self.centroids_.shape[0])
+        centroid_sqdist = (np.einsum('ij,ij->i', Q, Q)[:, None]
+                           - 2 * np.dot(Q, self.centroids_.T)
+                           + np.einsum('ij,ij->i', self.centroids_, self.centroids_)[None, :])
+        probes = np.argpartition(centroid_sqdist, n_probe - 1, axis=1)[:, :n_probe]
+
+        distances = np.full((Q.shape[0], n_neighbors), np.inf)
+        indices = np.full((Q.shape[0], n_neighbors), -1, dtype=np.int64)
+        for row, (q, cells) in enumerate(zip(Q, probes)):
+            # sorted, so a memory-mapped X is read front to back
+            candidates = np.sort(np.concatenate([self._order[self._offsets[c]:self._offsets[c+1]]
+                                                 for c in cells]))
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            sqdist = (np.dot(q, q) - 2 * np.dot(np.asarray(self._X[candidates]), q)
+                      + self._sqnorm[candidates])
+            d, i = _topk(sqdist[None, :], n_neighbors)
+            distances[row, :d.shape[1]] = d[0]
+            indices[row, :d.shape[1]] = candidates[i[0]]
+        return distances, indices
+
+class QuantizedBackend(object):
+    """ brute-force search over compact vectors, rescored at full precision.
+
+    dtype='float32' scans float32 codes (the vectors themselves when they are
+    stored as float32, the build default); dtype='int8' stores one byte per
+    dimension with a per-dimension scale and offset. a shortlist of
+    rescore * n_neighbors candidates from the compact scan is re-ranked
+    against the stored vectors (usually memory-mapped, so only the
+    shortlisted rows are read).
+    """
+
+    supports_mask = True
+    persisted_arrays = ('codes_', 'offset_', 'scale_', '_sqnorm')
+
+    def __init__(self, dtype='float32', rescore=4, block_size=16384):
+        if dtype not in ('float32', 'int8'):
+            raise ValueError('unsupported quantized dtype {!r}'.format(dtype))
+        self.dtype = dtype
+        self.rescore = rescore
+        self.block_size = block_size
+
+    def fit(self, X):
+        self._X = X
+        X = np.asarray(X)
+        if self.dtype == 'float32':
+            # no second float32 copy of float32 vectors
+            self.codes_ = None if X.dtype == np.float32 else X.astype(np.float32)
+            self.offset_ = np.zeros(X.shape[1], dtype=np.float32)
+            self.scale_ = np.ones(X.shape[1], dtype=np.float32)
+        else:
+            lo, hi = X.min(axis=0), X.max(axis=0)
+            self.offset_ = ((lo + hi) / 2).astype(np.float32)
+            self.scale_ = np.maximum((hi - lo) / 254, 1e-12).astype(np.float32)
+            self.codes_ = np.clip(np.rint((X - self.offset_) / self.scale_), -127, 127).astype(np.int8)
+
+        # squared norms of the decoded vectors, in code space
+        codes = self._codes
+        self._sqnorm = np.zeros(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], self.block_size):
+            c = codes[start:start+self.block_size].astype(np.float32) * self.scale_
+            self._sqnorm[start:start+self.block_size] = np.einsum('ij,ij->i', c, c)
+        return self
+
+    def __getstate__(self):
+        return _pickled_state(self)
+
+    def attach(self, X):
+        self._X = X
+
+    @property
+    def _codes(self):
+        return self._X if self.codes_ is None else self.codes_
+
+    def resident_arrays(self):
+        return (self._X, self.codes_, self.offset_, self.scale_, self._sqnorm)
+
+    def _approximate(self, Q, n_candidates, excluded=None):
+        """ shortlist by distance to the decoded compact vectors """
+        q = ((Q - self.offset_) / self.scale_).astype(np.float32)
+        weighted = q * self.scale_**2
+        qnorm = np.einsum('ij,ij->i', q * self.scale_, q * self.scale_)
+
+        best_d = np.empty((Q.shape[0], 0), dtype=np.float32)
+        best_i = np.empty((Q.shape[0], 0), dtype=np.int64)
+        codes = self._codes
+        for start in range(0, codes.shape[0], self.block_size):
+            c = np.asarray(codes[start:start+self.block_size], dtype=np.float32)
+            sqdist = qnorm[:, None] - 2 * np.dot(weighted, c.T) + self._sqnorm[None, start:start+c.shape[0]]
+            if excluded is not None:
+                sqdist[:, excluded[start:start+c.shape[0]]] = np.inf
+            sqdist = np.hstack((best_d, sqdist))
+            candidates = np.hstack((best_i, np.broadcast_to(
+                np.arange(start, start + c.shape[0]), (Q.shape[0], c.shape[0]))))
+            _, keep = _topk(sqdist, n_candidates)
+            best_d = np.take_along_axis(sqdist, keep, axis=1)
+            best_i = np.take_along_axis(candidates, keep, axis=1)
+        return best_d, best_i
+
+    def kneighbors(self, Q, n_neighbors=5, mask=None):
+        Q = np.atleast_2d(Q)
+        excluded = None if mask is None else ~np.asarray(mask, dtype=bool)
+        n_candidates = min(self._codes.shape[0], max(n_neighbors, self.rescore * n_neighbors))
+        approximate, shortlist = self._approximate(Q, n_candidates, excluded)
+
+        # exact rescoring of the shortlist
+        rows = np.unique(shortlist)
+        exact = np.asarray(self._X[rows])
+        position = np.searchsorted(rows, shortlist)
+        diff = exact[position] - Q[:, None, :]
+        sqdist = np.einsum('ijk,ijk->ij', diff, diff)
+        if excluded is not None:
+            sqdist[~np.isfinite(approximate)] = np.inf
+        d, i = _topk(sqdist, n_neighbors)
+        i = np.take_along_axis(shortlist, i, axis=1)
+        if excluded is not None:
+            return _pad_masked(d, i)
+        return d, i
+
+class SklearnBackend(object):
+    """ sklearn's exact NearestNeighbors, with its default algorithm choice """
+
+    def __init__(self, **params):
+        self.params = params
+
+    def fit(self, X):
+        from sklearn.neighbors import NearestNeighbors
+        self.model_ = NearestNeighbors(**self.params).fit(X)
+        return self
+
+    def kneighbors(self, Q, n_neighbors=5):
+        return self.model_.kneighbors(Q, n_neighbors)
+
+    def resident_arrays(self):
+        # the fitted vectors plus, for kd_tree and ball_tree,
+        # the tree's own data, index and node arrays
+        tree = getattr(self.model_, '_tree', None)
+        return ((getattr(self.model_, '_fit_X', None),)
+                + (tuple(tree.get_arrays()) if tree is not None else ()))
+
+# sharded search: each worker process holds one shard backend in _shard.
+# vectors reach the workers without a pickled copy, either as the
+# memory-mapped .npy file of a persisted build or as a shared memory block.
+_shard = None
+_shard_memory = None
+# serializes starting worker pools in the serving process
+_shard_lock = threading.Lock()
+
+def _open_shared(source):
+    global _shard_memory
+    kind = source[0]
+    if kind == 'npy':
+        return np.load(source[1], mmap_mode='r')
+    from multiprocessing import shared_memory
+    _, name, shape, dtype = source
+    _shard_memory = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=_shard_memory.buf)
+
+def _shard_init(source, start, stop, backend, params):
+    global _shard
+    _shard = make_backend(backend, params).fit(_open_shared(source)[start:stop])
+
+def _shard_kneighbors(Q, n_neighbors, mask):
+    if mask is None:
+        return _shard.kneighbors(Q, n_neighbors)
+    return _shard.kneighbors(Q, n_neighbors, mask=mask)
+
+def _close_shards(shards, memory):
+    for shard in shards:
+        shard.shutdown(wait=False)
+    if memory is not None:
+        memory.close()
+        memory.unlink()
+
+class ShardedBackend(object):
+    """ fan each query out to worker processes holding one shard each.
+
+    rows are split into n_shards contiguous shards (default: one per core),
+    each searched by its own shard_backend in a separate process; partial
+    top-k lists are merged here. workers start on the first query in each
+    process and map the vectors from the persisted build or from shared
+    memory, so no shard is copied through a pipe. inter-process round trips
+    cost about a millisecond, so this pays off for large indexes and
+    batched queries rather than single lookups on a small catalog.
+    """
+
+    def __init__(self, n_shards=None, shard_backend='brute', shard_params=None,
+                 start_method='spawn'):
+        self.n_shards = n_shards
+        self.shard_backend = shard_backend
+        self.shard_params = shard_params
+        self.start_method = start_method
+
+    @property
+    def supports_mask(self):
+        return getattr(BACKENDS[self.shard_backend], 'supports_mask', False)
+
+    def fit(self, X):
+        self._X = X
+        n_shards = min(self.n_shards or os.cpu_count() or 1, max(1, X.shape[0]))
+        self.bounds_ = np.linspace(0, X.shape[0], n_shards + 1).astype(int).tolist()
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_X', '_shards', '_pid', '_finalizer'):
+            state.pop(name, None)
+        return state
+
+    def attach(self, X):
+        self._X = X
+
+    # the shards are fitted and held by the worker processes
+    def resident_arrays(self):
+        return (self._X,)
+
+    def _share(self):
+        """ a picklable handle workers can map the vectors from """
+        X = self._X
+        filename = getattr(X, 'filename', None)
+        if isinstance(X, np.memmap) and filename and filename.endswith('.npy'):
+            if np.load(filename, mmap_mode='r').shape == X.shape:
+                return ('npy', filename), None
+
+        from multiprocessing import shared_memory
+        X = np.ascontiguousarray(X)
+        memory = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        np.ndarray(X.shape, dtype=X.dtype, buffer=memory.buf)[...] = X
+        return ('shm', memory.name, X.shape, X.dtype.str), memory
+
+    def _start(self):
+        # worker pools do not survive fork: start them once per process
+        if getattr(self, '_pid', None) == os.getpid():
+            return
+        import multiprocessing
+        import weakref
+        from concurrent.futures import ProcessPoolExecutor
+
+        with _shard_lock:
+            if getattr(self, '_pid', None) == os.getpid():
+                return
+            source, memory = self._share()
+            context = multiprocessing.get_context(self.start_method)
+            self._shards = [
+                ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_shard_init,
+                                    initargs=(source, start, stop,
+                                              self.shard_backend, self.shard_params))
+                for start, stop in zip(self.bounds_[:-1], self.bounds_[1:])
+            ]
+            self._finalizer = weakref.finalize(self, _close_shards, self._shards, memory)
+            self._pid = os.getpid()
+
+    def close(self):
+        """ stop the worker processes; the next query starts them again """
+        if getattr(self, '_pid', None) == os.getpid():
+            self._finalizer()
+        self._pid = None
+
+    def kneighbors(self, Q, n_neighbors=5, mask=None):
+        Q = np.ascontiguousarray(np.atleast_2d(Q))
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+        self._start()
+
+        shards = list(zip(self.bounds_[:-1], self.bounds_[1:], self._shards))
+        futures = [shard.submit(_shard_kneighbors, Q, min(n_neighbors, stop - start),
+                                None if mask is None else mask[start:stop])
+                   for start, stop, shard in shards]
+        distances, indices = [], []
+        try:
+            for (start, stop, shard), future in zip(shards, futures):
+                d, i = future.result()
+                distances.append(d)
+                indices.append(np.where(i >= 0, i + start, -1))
+        except Exception:
+            # e.g. a worker was killed: restart the pool on the next query
+            self.close()
+            raise
+
+        distances, indices = np.hstack(distances), np.hstack(indices)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+        return (np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(indices, order, axis=1))
+
+BACKENDS = {
+    'brute': BruteForceBackend,
+    'ivf': IVFBackend,
+    'quantized': QuantizedBackend,
+    'sharded': ShardedBackend,
+    'sklearn': SklearnBackend,
+}
+
+def make_backend(name='brute', params=None):
+    """ construct a neighbor search backend by name """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError('unknown search backend {!r}; choose from {}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+    return backend(**(params or {}))
+
+class SearchIndex(object):
+    """ an immutable snapshot of the served similarity index.
+
+    the main segment is searched through a fitted backend; vectors added by
+    `index append` since the last fit sit in a small delta segment searched
+    by brute force. updates build a new SearchIndex and swap it in with a
+    single assignment, so readers never block and always see a consistent index.
+
+    graph, if given, is the precomputed (neighbors, distances) pair written
+    by build_graph: the exact top-k rows for every main-segment row. it is
+    ignored while a delta segment is present, since new vectors can
+    displace any row's neighbors.
+
+    keys are int64 arrays (the main segment's usually memory-mapped);
+    rows_for looks primary keys up in a sorted copy, so no per-key python
+    objects are held.
+    """
+
+    def __init__(self, keys, vectors, nneighs, version, projection=None,
+                 backend=('brute', None), delta_keys=(), delta_vectors=None, generation=0,
+                 graph=None):
+        self.main_keys = np.asarray(keys, dtype=np.int64)
+        self.vectors = vectors
+        self.nneighs = nneighs
+        self._build_graph = graph
+        self.graph = graph if not len(delta_keys) else None
+        self.base_version = version
+        self.generation = generation
+        self.projection = projection
+        self.backend = backend
+
+        self.delta_keys = np.asarray(delta_keys, dtype=np.int64)
+        if delta_vectors is None:
+            delta_vectors = np.empty((0, vectors.shape[1]), dtype=vectors.dtype)
+        self.delta_vectors = delta_vectors
+        self.delta = None
+        if len(self.delta_keys):
+            self.delta = BruteForceBackend().fit(delta_vectors)
+            self.keys = np.concatenate((self.main_keys, self.delta_keys))
         else:
-            g = f
-            
-        for key in keys:
-            xx = g[key][...]
-            X.append(g[key][...])
+            self.keys = self.main_keys
+        self._key_order = np.argsort(self.keys, kind='stable')
+        self._sorted_keys = self.keys[self._key_order]
+
+    @property
+    def version(self):
+        if self.generation == 0:
+            return self.base_version
+        return '{}.{}'.format(self.base_version, self.generation)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows_for(self, keys):
+        """ rows of self.keys holding each primary key; -1 for keys not in the index """
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(self._sorted_keys):
+            return np.full(keys.shape, -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        return np.where(self._sorted_keys[position] == keys, self._key_order[position], -1)
+
+    @property
+    def nbytes(self):
+        """ bytes held by the reduced vectors of both segments """
+        return self.vectors.nbytes + self.delta_vectors.nbytes
+
+    @property
+    def resident_nbytes(self):
+        """ bytes held in process memory: keys and vectors not memory-mapped,
+        the key lookup arrays and whatever the backends built from them
+        (cells, codes, trees) """
+        arrays = [self.vectors, self.delta_vectors, self.keys, self.delta_keys,
+                  self._key_order, self._sorted_keys]
+        for backend in (self.nneighs, self.delta):
+            if hasattr(backend, 'resident_arrays'):
+                arrays.extend(backend.resident_arrays())
+        return _resident_nbytes(*arrays)
+
+    def vectors_for(self, rows):
+        """ reduced feature vectors for rows of self.keys """
+        rows = np.asarray(rows, dtype=np.int64)
+        n_main = len(self.main_keys)
+        if not len(self.delta_keys):
+            return np.asarray(self.vectors[rows])
+        X = np.empty((rows.size, self.vectors.shape[1]), dtype=self.vectors.dtype)
+        in_main = rows < n_main
+        X[in_main] = self.vectors[rows[in_main]]
+        X[~in_main] = self.delta_vectors[rows[~in_main] - n_main]
+        return X
+
+    def kneighbors(self, Q, n_neighbors, mask=None):
+        """ search both segments; indices are rows of self.keys, -1 for padding.
+
+        mask, a boolean array aligned with self.keys, restricts the search
+        to the selected rows.
+        """
+        n_main = len(self.main_keys)
+        if mask is None:
+            distances, indices = self.nneighs.kneighbors(Q, min(n_neighbors, n_main))
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            distances, indices = self._filtered_kneighbors(Q, n_neighbors, mask[:n_main])
+        if self.delta is None:
+            return distances, indices
+
+        d, i = self.delta.kneighbors(Q, min(n_neighbors, len(self.delta_keys)),
+                                     mask=None if mask is None else mask[n_main:])
+        distances = np.hstack((distances, d))
+        indices = np.hstack((indices, np.where(i >= 0, i + n_main, -1)))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+        return (np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(indices, order, axis=1))
 
-    return np.array(X)
+    def _filtered_kneighbors(self, Q, n_neighbors, mask):
+        """ main-segment search restricted to mask """
+        Q = np.atleast_2d(Q)
+        rows = np.flatnonzero(mask)
+        if rows.size == 0:
+            return (np.empty((Q.shape[0], 0)), np.empty((Q.shape[0], 0), dtype=np.int64))
+        if (getattr(self.nneighs, 'supports_mask', False)
+                and rows.size > EXACT_FILTER_FRACTION * mask.size):
+            return self.nneighs.kneighbors(Q, min(n_neighbors, mask.size), mask=mask)
 
+        # selective filters: scanning only the selected vectors is cheaper
+        # than a masked pass over everything, and exact
+        subset = BruteForceBackend().fit(np.asarray(self.vectors[rows]))
+        distances, indices = subset.kneighbors(Q, min(n_neighbors, rows.size))
+        return distances, rows[indices]
 
-def build_search_tree(datadir, featurename='vgg16_block5_conv3-vlad-64.h5'):
+    def graph_neighbors(self, rows, n_neighbors):
+        """ precomputed (distances, indices) for rows, self-matches excluded.
+
+        None if there is no graph or it holds fewer than n_neighbors per row.
+        """
+        if self.graph is None:
+            return None
+        neighbors, distances = self.graph
+        if n_neighbors > neighbors.shape[1]:
+            return None
+        rows = np.asarray(rows, dtype=np.int64)
+        return (np.asarray(distances[rows, :n_neighbors]),
+                np.asarray(neighbors[rows, :n_neighbors], dtype=np.int64))
+
+    def with_delta(self, delta_keys, delta_vectors, generation):
+        """ a new index sharing this main segment, with a replacement delta segment """
+        return SearchIndex(self.main_keys, self.vectors, self.nneighs, self.base_version,
+                           projection=self.projection, backend=self.backend,
+                           delta_keys=delta_keys, delta_vectors=delta_vectors,
+                           generation=generation, graph=self._build_graph)
+
+def set_index(new_index):
+    """ atomically replace the served index """
+    global index
+    index = new_index
+
+def create_search_index(datadir, featurename='vgg16_block5_conv3-vlad-64.h5',
+                        backend=None, backend_params=None, dtype='float32'):
+    """ fit PCA and a neighbor backend (brute force by default) in-process
+    and return the SearchIndex """
+    backend = backend or 'brute'
 
     ndim = 64
     features_file = os.path.join(datadir, featurename)
     print(features_file)
+    t0 = time.time()
     
-    global keys, features
-    keys, features = load_features(features_file)
+    keys, features = load_feature_store(features_file)
 
     print('reducing features')
-    pca = PCA(n_components=ndim)
-    features = pca.fit_transform(features)
+    mean, components = fit_projection(features, ndim=ndim)
+    features = project(features, mean, components).astype(dtype)
     print('ready')
 
     print('building search tree')
-    nn = NearestNeighbors()
-    
-    global nneighs
+    nn = make_backend(backend, backend_params)
     nneighs = nn.fit(features)
+
+    search_index = SearchIndex(keys, features, nneighs, 'live-{}'.format(time.time()),
+                               projection=(mean, components), backend=(backend, backend_params))
+    metrics.index_load_seconds.set(time.time() - t0, 'build')
     print('ready')
+    return search_index
+
+def build_search_tree(datadir, featurename='vgg16_block5_conv3-vlad-64.h5',
+                      backend=None, backend_params=None):
+    search_index = create_search_index(datadir, featurename, backend, backend_params)
+    with _index_lock:
+        set_index(search_index)
+
+
+# persisted search index:
+# <indexdir>/<name>/<build_id>/ holds the PCA basis (mean.npy, components.npy),
+# the reduced vectors (vectors.npy, float32 unless built with another dtype),
+# their primary keys (keys.npy), the fitted neighbor model (nneighs.pkl, plus
+# its large arrays as nneighs-<name>.npy) and the build metadata (meta.json).
+# `build_graph` adds the precomputed top-k neighbor graph to a build
+# (graph_neighbors.npy, graph_distances.npy).
+# `append_index` adds projected vectors for new micrographs as a delta
+# segment (delta-<generation>.keys.npy, delta-<generation>.vectors.npy,
+# named by meta.json's delta_generation) that workers attach without a refit;
+# `compact_index` folds the delta into a new build.
+# <indexdir>/<name>/current names the build the web app should serve.
+# bump whenever the artifacts or a backend's pickled layout change: load_index
+# rejects other versions, so old builds are rebuilt rather than converted.
+INDEX_VERSION = 2
+
+def index_name(featurename):
+    return os.path.splitext(os.path.basename(featurename))[0]
+
+def _write_build(indexdir, name, build_id, arrays, nn, meta):
+    """ write index artifacts, then point <name>/current at the new build """
+    builddir = os.path.join(indexdir, name, build_id)
+    os.makedirs(builddir, exist_ok=True)
+
+    for key in ('mean', 'components', 'vectors', 'keys'):
+        _atomic_save(os.path.join(builddir, key + '.npy'), arrays[key])
+    for key in getattr(nn, 'persisted_arrays', ()):
+        if getattr(nn, key) is not None:
+            _atomic_save(_persisted_array_path(builddir, key), getattr(nn, key))
+    with open(os.path.join(builddir, 'nneighs.pkl'), 'wb') as f:
+        pickle.dump(nn, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    meta = dict(meta, version=INDEX_VERSION, build_id=build_id,
+                built=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    _atomic_dump(os.path.join(builddir, 'meta.json'), meta)
+
+    # switch the served build only once every artifact is in place
+    current = os.path.join(indexdir, name, 'current')
+    tmp = '{}.{}.tmp'.format(current, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(build_id)
+    os.replace(tmp, current)
+
+    return builddir
+
+def build_index(featuresfile, indexdir, ndim=64, random_state=0,
+                backend='brute', backend_params=None, dtype='float32'):
+    """ fit the PCA projection and neighbor model once and write them to disk.
+    the reduced vectors are stored as dtype """
+    keys, X = load_feature_store(featuresfile)
+    with open(feature_store_path(featuresfile) + '.json', 'r') as f:
+        source = json.load(f)
+
+    t0 = time.time()
+    mean, components = fit_projection(X, ndim=ndim, random_state=random_state)
+    vectors = project(X, mean, components).astype(dtype)
+    nn = make_backend(backend, backend_params).fit(vectors)
+    elapsed = time.time() - t0
+
+    build_id = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), source['sha1'][:8])
+    arrays = dict(mean=mean, components=components, vectors=vectors,
+                  keys=np.array(keys, dtype=np.int64))
+    meta = dict(
+        build_seconds=elapsed,
+        source=source['source'],
+        source_sha1=source['sha1'],
+        n_samples=len(keys),
+        n_features=int(X.shape[1]),
+        ndim=int(ndim),
+        dtype=np.dtype(dtype).name,
+        random_state=random_state,
+        backend=backend,
+        backend_params=backend_params or {}
+    )
+    with _writer_lock(indexdir, featuresfile):
+        return _write_build(indexdir, index_name(featuresfile), build_id, arrays, nn, meta)
+
+# the delta segment is searched by brute force next to the main backend;
+# `index append` starts a background `index compact` once it holds more
+# than this fraction of the main segment's vectors
+COMPACT_FRACTION = 0.1
+
+@contextmanager
+def _writer_lock(indexdir, featurename):
+    """ serialize processes writing one index (build, append, compact), so a
+    compaction never switches builds under an append to the previous one """
+    import fcntl
+    namedir = os.path.join(indexdir, index_name(featurename))
+    os.makedirs(namedir, exist_ok=True)
+    with open(os.path.join(namedir, 'writer.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def needs_compaction(builddir, fraction=COMPACT_FRACTION):
+    """ whether the build's delta segment has outgrown fraction of its main segment """
+    with open(os.path.join(builddir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    return meta.get('n_delta', 0) > fraction * meta['n_samples']
+
+def _delta_path(builddir, generation, name):
+    return os.path.join(builddir, 'delta-{}.{}.npy'.format(generation, name))
+
+def load_delta(builddir, meta):
+    """ (keys, vectors, generation) of a build's delta segment """
+    generation = meta.get('delta_generation', 0)
+    if not generation:
+        return [], None, 0
+    keys = np.load(_delta_path(builddir, generation, 'keys')).tolist()
+    vectors = np.load(_delta_path(builddir, generation, 'vectors'))
+    return keys, vectors, generation
+
+def append_index(featuresfile, indexdir, newfile, perplexity=40):
+    """ add vectors from newfile to the current build's delta segment.
+
+    new features are projected onto the stored basis; keys already in the
+    index are skipped. nothing is refit: serving workers attach the new
+    delta segment on their next index poll (see watch_index).
+    """
+    with _writer_lock(indexdir, featuresfile):
+        builddir = index_path(indexdir, featuresfile)
+        if builddir is None:
+            raise ValueError('no index built for {}'.format(featuresfile))
+        artifacts = load_index(builddir)
+        meta = artifacts['meta']
+        delta_keys, delta_vectors, generation = load_delta(builddir, meta)
+
+        new_keys, X = load_features(newfile, perplexity=perplexity)
+        existing = set(artifacts['keys'].tolist()) | set(delta_keys)
+        keep = [row for row, key in enumerate(new_keys) if key not in existing]
+        if not keep:
+            return builddir, 0
 
-def query(entry_id, n_results=16):
-    scikit_id = keys.index(entry_id)
-    query_vector = features[scikit_id]
+        new_vectors = project(X[keep], artifacts['mean'], artifacts['components']).astype(
+            artifacts['vectors'].dtype)
+        if delta_vectors is not None:
+            new_vectors = np.vstack((delta_vectors, new_vectors))
+        keys = np.array(delta_keys + [new_keys[row] for row in keep], dtype=np.int64)
 
-    # nearest neighbor will be a self-match
-    scores, results = nneighs.kneighbors(query_vector, n_results+1)
-    scores, results = scores.flatten()[1:], results.flatten()[1:]
+        # each generation gets fresh files, and meta.json switches to it last,
+        # so readers never pair keys and vectors from different generations
+        generation += 1
+        _atomic_save(_delta_path(builddir, generation, 'keys'), keys)
+        _atomic_save(_delta_path(builddir, generation, 'vectors'), new_vectors)
+        _atomic_dump(os.path.join(builddir, 'meta.json'),
+                     dict(meta, delta_generation=generation, n_delta=int(keys.size)))
+
+        # keep the previous generation for workers that read meta.json just before
+        for name in ('keys', 'vectors'):
+            try:
+                os.remove(_delta_path(builddir, generation - 2, name))
+            except OSError:
+                pass
+        return builddir, len(keep)
+
+def compact_index(featuresfile, indexdir):
+    """ fold the delta segment into a new build, refitting only the neighbor backend """
+    with _writer_lock(indexdir, featuresfile):
+        builddir = index_path(indexdir, featuresfile)
+        if builddir is None:
+            raise ValueError('no index built for {}'.format(featuresfile))
+        artifacts = load_index(builddir)
+        meta = artifacts['meta']
+        delta_keys, delta_vectors, generation = load_delta(builddir, meta)
+        if not delta_keys:
+            return builddir, 0
+
+        t0 = time.time()
+        vectors = np.vstack((np.asarray(artifacts['vectors']), delta_vectors))
+        keys = np.concatenate((artifacts['keys'], np.array(delta_keys, dtype=np.int64)))
+        nn = make_backend(meta['backend'], meta['backend_params']).fit(vectors)
+
+        build_id = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'),
+                                  hashlib.sha1(keys.tobytes()).hexdigest()[:8])
+        arrays = dict(mean=artifacts['mean'], components=artifacts['components'],
+                      vectors=vectors, keys=keys)
+        new_meta = dict(meta, build_seconds=time.time() - t0, n_samples=int(keys.size),
+                        parent=meta['build_id'], n_compacted=len(delta_keys))
+        # the parent's graph does not cover the delta vectors
+        for name in ('graph_k', 'graph_seconds', 'delta_generation', 'n_delta'):
+            new_meta.pop(name, None)
+        return _write_build(indexdir, index_name(featuresfile), build_id, arrays, nn, new_meta), len(delta_keys)
+
+def index_path(indexdir, featurename):
+    """ directory of the currently served build, or None if there is none """
+    name = index_name(featurename)
+    try:
+        with open(os.path.join(indexdir, name, 'current'), 'r') as f:
+            build_id = f.read().strip()
+    except (IOError, OSError):
+        return None
+    return os.path.join(indexdir, name, build_id)
+
+def load_index(builddir):
+    """ load persisted index artifacts; arrays are memory-mapped """
+    with open(os.path.join(builddir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != INDEX_VERSION:
+        raise ValueError('unsupported index version {} in {}'.format(meta.get('version'), builddir))
+
+    artifacts = dict(meta=meta)
+    for name in ('mean', 'components', 'vectors', 'keys'):
+        artifacts[name] = np.load(os.path.join(builddir, name + '.npy'), mmap_mode='r')
+    with open(os.path.join(builddir, 'nneighs.pkl'), 'rb') as f:
+        artifacts['nneighs'] = pickle.load(f)
+    for key in getattr(artifacts['nneighs'], 'persisted_arrays', ()):
+        path = _persisted_array_path(builddir, key)
+        setattr(artifacts['nneighs'], key,
+                np.load(path, mmap_mode='r') if os.path.exists(path) else None)
+    if hasattr(artifacts['nneighs'], 'attach'):
+        artifacts['nneighs'].attach(artifacts['vectors'])
+    if meta.get('graph_k'):
+        artifacts['graph'] = tuple(
+            np.load(os.path.join(builddir, name + '.npy'), mmap_mode='r')
+            for name in ('graph_neighbors', 'graph_distances'))
+    return artifacts
+
+def compute_graph(vectors, k=32, n_jobs=None, memory_mb=1024):
+    """ exact k nearest neighbors of every row, as (neighbors, distances).
+
+    the all-pairs distances are computed one tile at a time and folded into
+    running top-k lists (see _tiled_kneighbors), so temporary memory is
+    bounded by memory_mb in total, split evenly across n_jobs threads
+    (numpy releases the GIL in the matrix product and partition).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    X = np.ascontiguousarray(vectors, dtype=np.float64)
+    n = X.shape[0]
+    k = min(k, n - 1)
+    sqnorm = np.einsum('ij,ij->i', X, X)
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    budget = memory_mb * 1024**2 // n_jobs
+    block_size, _ = _tile_shape(n, n, budget)
+
+    neighbors = np.empty((n, k), dtype=np.int32)
+    distances = np.empty((n, k), dtype=np.float32)
+
+    def run(start):
+        stop = min(start + block_size, n)
+        d, i = _tiled_kneighbors(X[start:stop], X, sqnorm, k, budget, self_offset=start)
+        neighbors[start:stop] = i
+        distances[start:stop] = d
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # list() re-raises any worker exception
+        list(pool.map(run, range(0, n, block_size)))
+    return neighbors, distances
+
+def build_graph(builddir, k=32, n_jobs=None, memory_mb=1024):
+    """ add the precomputed neighbor graph to an index build """
+    artifacts = load_index(builddir)
+    t0 = time.time()
+    neighbors, distances = compute_graph(artifacts['vectors'], k=k,
+                                         n_jobs=n_jobs, memory_mb=memory_mb)
+    elapsed = time.time() - t0
+
+    _atomic_save(os.path.join(builddir, 'graph_neighbors.npy'), neighbors)
+    _atomic_save(os.path.join(builddir, 'graph_distances.npy'), distances)
+    # meta.json is written last: readers only look for the graph once it names graph_k
+    meta = dict(artifacts['meta'], graph_k=int(neighbors.shape[1]), graph_seconds=elapsed)
+    _atomic_dump(os.path.join(builddir, 'meta.json'), meta)
+    return meta
+
+def open_search_index(indexdir, featurename, backend=None, backend_params=None):
+    """ load a prebuilt index as a SearchIndex; None if none has been built.
+
+    if backend names a different backend than the one persisted with the
+    index, refit that backend on the stored vectors.
+    """
+    builddir = index_path(indexdir, featurename)
+    if builddir is None:
+        return None
+
+    t0 = time.time()
+    artifacts = load_index(builddir)
+    meta = artifacts['meta']
+    built_with = (meta['backend'], meta['backend_params'])
+    if backend is not None and (backend, backend_params or {}) != built_with:
+        print('refitting {} backend (index built with {})'.format(backend, built_with[0]))
+        artifacts['nneighs'] = make_backend(backend, backend_params).fit(artifacts['vectors'])
+        built_with = (backend, backend_params)
+
+    delta_keys, delta_vectors, generation = load_delta(builddir, meta)
+    search_index = SearchIndex(artifacts['keys'], artifacts['vectors'],
+                               artifacts['nneighs'], meta['build_id'],
+                               projection=(artifacts['mean'], artifacts['components']),
+                               backend=built_with, graph=artifacts.get('graph'),
+                               delta_keys=delta_keys, delta_vectors=delta_vectors,
+                               generation=generation)
+    metrics.index_load_seconds.set(time.time() - t0, 'load')
+    print('loaded index {}'.format(meta['build_id']))
+    return search_index
+
+def load_search_index(indexdir, featurename, backend=None, backend_params=None, prepare=None):
+    """ serve a prebuilt index; returns False if none has been built.
+    prepare, if given, is called with the index before it is served """
+    search_index = open_search_index(indexdir, featurename, backend, backend_params)
+    if search_index is None:
+        return False
+    if prepare is not None:
+        prepare(search_index)
+    with _index_lock:
+        set_index(search_index)
+    return True
+
+def reload_search_index(indexdir, featurename, backend=None, backend_params=None, prepare=None):
+    """ swap in the current build if it is newer than the one being served.
+
+    when only the delta segment changed, attach it to the served main segment.
+    """
+    builddir = index_path(indexdir, featurename)
+    if builddir is None:
+        return False
+    if index is None or os.path.basename(builddir) != index.base_version:
+        return load_search_index(indexdir, featurename, backend, backend_params, prepare)
+
+    with open(os.path.join(builddir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('delta_generation', 0) == index.generation:
+        return False
+    delta_keys, delta_vectors, generation = load_delta(builddir, meta)
+    search_index = index.with_delta(delta_keys, delta_vectors, generation)
+    if prepare is not None:
+        prepare(search_index)
+    with _index_lock:
+        set_index(search_index)
+    print('attached delta generation {} ({} vectors)'.format(generation, len(delta_keys)))
+    return True
+
+def watch_index(indexdir, featurename, interval=60, **kwargs):
+    """ poll for new builds in a daemon thread, e.g. after `index append` """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_search_index(indexdir, featurename, **kwargs)
+            except Exception as e:
+                print('could not reload index: {}'.format(e))
+
+    thread = threading.Thread(target=run, name='index-watcher')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class IndexWarmup(object):
+    """ run an index loader once per process in a daemon thread.
+
+    state moves from 'idle' to 'loading' to 'ready' (or 'failed', with the
+    exception kept in error); whatever the loader returns is kept in
+    result. start() is idempotent within a process and
+    starts over in a forked child, so it is safe to call on every request.
+    a failed load starts over on the first start() at least retry_seconds
+    after it failed.
+    """
+
+    def __init__(self, loader, retry_seconds=30):
+        self.loader = loader
+        self.retry_seconds = retry_seconds
+        self.pid = None
+        self.state = 'idle'
+        self.error = None
+        self.started = None
+        self.elapsed = None
+        self.result = None
+        self._retry_at = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.pid == os.getpid() and self._ready.is_set()
+
+    def _retry_due(self):
+        retry_at = self._retry_at
+        return retry_at is not None and time.time() >= retry_at
+
+    def start(self):
+        pid = os.getpid()
+        if self.pid == pid and not self._retry_due():
+            return
+        with self._lock:
+            if self.pid == pid and not self._retry_due():
+                return
+            # threads do not survive fork: reset whatever the parent recorded
+            self.pid = pid
+            self.state, self.error, self.elapsed, self.result = 'loading', None, None, None
+            self._retry_at = None
+            self.started = time.time()
+            self._ready = threading.Event()
+            thread = threading.Thread(target=self._run, name='index-warmup')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        try:
+            self.result = self.loader()
+        except Exception as e:
+            print('index warm-up failed: {!r}; retrying in {}s'.format(e, self.retry_seconds))
+            self.elapsed = time.time() - self.started
+            self.state, self.error = 'failed', e
+            self._retry_at = time.time() + self.retry_seconds
+        else:
+            self.elapsed = time.time() - self.started
+            self.state = 'ready'
+        self._ready.set()
+
+    def wait(self, timeout=None):
+        """ block until the load finishes or timeout elapses; True if the index is live """
+        self._ready.wait(timeout)
+        return self.state == 'ready'
+
+    def status(self):
+        return dict(state=self.state, pid=self.pid,
+                    error=None if self.error is None else repr(self.error),
+                    elapsed=self.elapsed)
+
+class IndexRegistry(object):
+    """ search indexes for several representations, loaded lazily on first use.
+
+    each representation loads in the background through its own
+    IndexWarmup, so a request never runs the load itself; see warmup().
+    loaded indexes are kept in LRU order and evicted once their combined
+    resident_nbytes exceed max_bytes. the default representation is the
+    module-level index and is always served, never evicted.
+    """
+
+    def __init__(self, loader, max_bytes, default=None, retry_seconds=30):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.default = default
+        self.retry_seconds = retry_seconds
+        self._indexes = OrderedDict()
+        self._warmups = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(search_index.resident_nbytes for search_index in list(self._indexes.values()))
+
+    def get(self, representation):
+        """ the loaded index for representation, or None if it is not loaded """
+        if representation is None or representation == self.default:
+            return index
+        with self._lock:
+            search_index = self._indexes.get(representation)
+            if search_index is not None:
+                self._indexes.move_to_end(representation)
+            return search_index
+
+    def warmup(self, representation):
+        """ the started IndexWarmup loading representation.
+
+        a failed load is retried after retry_seconds; an evicted index
+        is loaded again.
+        """
+        with self._lock:
+            warmup = self._warmups.get(representation)
+            if warmup is None:
+                warmup = IndexWarmup(lambda: self._load(representation),
+                                     retry_seconds=self.retry_seconds)
+                self._warmups[representation] = warmup
+        warmup.start()
+        return warmup
+
+    def _load(self, representation):
+        search_index = self.loader(representation)
+        with self._lock:
+            self._indexes[representation] = search_index
+            self._evict(keep=representation)
+        return search_index
+
+    def _evict(self, keep):
+        budget = self.max_bytes
+        if index is not None:
+            budget -= index.resident_nbytes
+        while len(self._indexes) > 1 and self.nbytes > budget:
+            name = next(iter(self._indexes))
+            if name == keep:
+                self._indexes.move_to_end(name)
+                continue
+            print('evicting search index for {}'.format(name))
+            del self._indexes[name]
+            self._warmups.pop(name, None)
+
+def query(entry_id, n_results=16, search_index=None, mask=None):
+    """ nearest neighbors of one micrograph, optionally restricted to a
+    boolean mask over the index keys (see search.FilterMasks) """
+    idx = search_index if search_index is not None else index
+    scikit_id = int(idx.rows_for([entry_id])[0])
+    if scikit_id < 0:
+        raise KeyError(entry_id)
+
+    # a single row lookup when the build carries a precomputed graph
+    precomputed = None if mask is not None else idx.graph_neighbors([scikit_id], n_results)
+    if precomputed is not None:
+        scores, results = precomputed[0].flatten(), precomputed[1].flatten()
+    elif mask is not None:
+        mask = np.array(mask, dtype=bool)
+        mask[scikit_id] = False
+        with metrics.knn_query_seconds.time('single'):
+            scores, results = idx.kneighbors(idx.vectors_for([scikit_id]), n_results, mask=mask)
+        scores, results = scores.flatten(), results.flatten()
+    else:
+        query_vector = idx.vectors_for([scikit_id])
+        # nearest neighbor will be a self-match
+        with metrics.knn_query_seconds.time('single'):
+            scores, results = idx.kneighbors(query_vector, n_results+1)
+        scores, results = scores.flatten()[1:], results.flatten()[1:]
+    valid = results >= 0
+    scores, results = scores[valid], results[valid]
     
-    result_entries = map(keys.__getitem__, results)
+    result_entries = idx.keys[results].tolist()
     scores = ['{:0.4f}'.format(score) for score in scores]
 
     return scores, result_entries
 
+def batch_query(entry_ids, n_results=16, search_index=None, mask=None):
+    """ nearest neighbors for many micrographs with one kneighbors call.
+
+    returns (entry_id, distances, neighbor_keys) for each entry_id;
+    distances and neighbor_keys are None for ids missing from the index.
+    mask optionally restricts neighbors to a boolean mask over the index keys.
+    """
+    idx = search_index if search_index is not None else index
+    rows = idx.rows_for(entry_ids)
+    found = rows[rows >= 0]
+
+    if len(found):
+        precomputed = None if mask is not None else idx.graph_neighbors(found, n_results)
+        if precomputed is not None:
+            distances, results = precomputed
+        else:
+            # nearest neighbor will be a self-match (unless the mask excludes it)
+            n_neighbors = min(n_results + 1, len(idx))
+            with metrics.knn_query_seconds.time('batch'):
+                distances, results = idx.kneighbors(idx.vectors_for(found), n_neighbors, mask=mask)
+            if mask is None:
+                distances, results = distances[:, 1:], results[:, 1:]
+
+    batch, n = [], 0
+    for entry_id, row in zip(entry_ids, rows):
+        if row < 0:
+            batch.append((entry_id, None, None))
+            continue
+        # approximate and filtered searches pad short result lists with -1
+        valid = (results[n] >= 0) & (results[n] != row)
+        neighbors = results[n][valid][:n_results]
+        batch.append((entry_id, distances[n][valid][:n_results], idx.keys[neighbors]))
+        n += 1
+
+    return batch
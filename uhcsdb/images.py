@@ -0,0 +1,157 @@
+""" derive web images and thumbnails from the source micrographs
+
+python -m uhcsdb.images build --source uhcsdata/micrographs
+
+for every micrograph in the database, converts the source image named by
+Micrograph.path into
+  static/micrographs-fullsize/micrographN.png  full resolution
+  static/micrographs/micrographN.png           web size
+  static/thumbs/micrographN.png                default thumbnail
+  static/thumbs-<size>/micrographN.png         additional thumbnail sizes
+and records dimensions and content hashes in static/image-manifest.json.
+outputs newer than their source are skipped.
+"""
+import os
+import json
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+DEFAULT_DATABASE = 'uhcsdb/microstructures.sqlite'
+DEFAULT_STATIC = 'uhcsdb/static'
+MANIFEST = 'image-manifest.json'
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def output_paths(micrograph_id, web_size, thumb_sizes):
+    """ static-relative output path for each derived image, with its max dimension """
+    name = 'micrograph{}.png'.format(micrograph_id)
+    outputs = [(os.path.join('micrographs-fullsize', name), None),
+               (os.path.join('micrographs', name), web_size),
+               (os.path.join('thumbs', name), thumb_sizes[0])]
+    for size in thumb_sizes[1:]:
+        outputs.append((os.path.join('thumbs-{}'.format(size), name), size))
+    return outputs
+
+def _to_8bit(image):
+    """ browsers expect 8 bit images; rescale 16 bit and float sources """
+    import numpy as np
+    from PIL import Image
+
+    if image.mode in ('L', 'RGB'):
+        return image
+    if image.mode in ('I;16', 'I;16B', 'I', 'F'):
+        a = np.asarray(image, dtype=np.float64)
+        lo, hi = a.min(), a.max()
+        a = 255 * (a - lo) / max(hi - lo, 1e-12)
+        return Image.fromarray(a.astype(np.uint8), mode='L')
+    return image.convert('RGB')
+
+def derive(task):
+    """ write all derived images for one micrograph; runs in a pool worker """
+    source, staticdir, outputs, force = task
+    from PIL import Image
+
+    source_mtime = os.path.getmtime(source)
+    stale = [(path, size) for path, size in outputs
+             if force or not os.path.exists(os.path.join(staticdir, path))
+             or os.path.getmtime(os.path.join(staticdir, path)) < source_mtime]
+
+    if stale:
+        image = _to_8bit(Image.open(source))
+        for path, size in stale:
+            dest = os.path.join(staticdir, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            out = image.copy()
+            if size is not None:
+                out.thumbnail((size, size), Image.LANCZOS)
+            tmp = dest + '.tmp'
+            out.save(tmp, format='PNG', optimize=True)
+            os.replace(tmp, dest)
+
+    return [path for path, size in stale]
+
+def describe(staticdir, path):
+    """ manifest record for a derived image """
+    from PIL import Image
+
+    fullpath = os.path.join(staticdir, path)
+    with Image.open(fullpath) as image:
+        width, height = image.size
+    st = os.stat(fullpath)
+    return dict(width=width, height=height, bytes=st.st_size,
+                mtime=st.st_mtime, sha1=_sha1(fullpath))
+
+def load_manifest(staticdir):
+    try:
+        with open(os.path.join(staticdir, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def build(args):
+    from uhcsdb.database import session_scope
+    from uhcsdb.models import Micrograph
+
+    with session_scope(args.db) as db:
+        micrographs = db.query(Micrograph.micrograph_id, Micrograph.path).all()
+
+    tasks, missing = [], 0
+    for micrograph_id, path in micrographs:
+        source = os.path.join(args.source, path)
+        if not os.path.exists(source):
+            missing += 1
+            continue
+        outputs = output_paths(micrograph_id, args.web_size, args.thumb_size)
+        tasks.append((source, args.static, outputs, args.force))
+
+    manifest = load_manifest(args.static)
+    n_written = 0
+    with Pool(args.jobs) as pool:
+        for written in pool.imap_unordered(derive, tasks, chunksize=8):
+            n_written += len(written)
+            for path in written:
+                manifest.pop(path, None)
+
+    # hash new outputs, and any whose file changed since the manifest was written
+    for source, staticdir, outputs, force in tasks:
+        for path, size in outputs:
+            record = manifest.get(path)
+            if record is None or record['mtime'] != os.path.getmtime(os.path.join(staticdir, path)):
+                manifest[path] = describe(staticdir, path)
+
+    tmp = os.path.join(args.static, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(args.static, MANIFEST))
+
+    print('{} micrographs, {} images written, {} sources missing'.format(
+        len(tasks), n_written, missing))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='derive web images and thumbnails')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='convert source micrographs')
+    build_parser.add_argument('--source', required=True, help='directory holding the source images')
+    build_parser.add_argument('--db', default=DEFAULT_DATABASE, help='sqlite metadata store')
+    build_parser.add_argument('--static', default=DEFAULT_STATIC, help='flask static directory')
+    build_parser.add_argument('--web-size', type=int, default=1024, help='max dimension of web images')
+    build_parser.add_argument('--thumb-size', type=int, action='append',
+                              help='thumbnail max dimension (repeatable; default 128 and 256)')
+    build_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    build_parser.add_argument('--force', action='store_true', help='rebuild up-to-date images')
+    build_parser.set_defaults(func=build)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    if args.command == 'build' and not args.thumb_size:
+        args.thumb_size = [128, 256]
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
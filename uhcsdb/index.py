@@ -0,0 +1,202 @@
+""" offline construction of the similarity search index
+
+python -m uhcsdb.index build --features uhcsdb/static/representations/vgg16_multiscale_block5_conv3-vlad-32.h5
+python -m uhcsdb.index append --new new_micrographs.h5 [--compact-fraction 0.1 | --no-compact]
+python -m uhcsdb.index compact
+python -m uhcsdb.index graph -k 32 --jobs 8
+python -m uhcsdb.index bench --backend ivf --backend quantized --param n_probe=4 --param dtype=int8
+python -m uhcsdb.index build --backend sharded --param n_shards=8
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import numpy as np
+
+from uhcsdb import features
+
+DEFAULT_FEATURES = 'uhcsdb/static/representations/vgg16_multiscale_block5_conv3-vlad-32.h5'
+DEFAULT_INDEX_PATH = 'uhcsdb/static/index'
+
+def parse_params(params):
+    """ parse repeated --param name=value options into backend kwargs """
+    parsed = {}
+    for param in params or []:
+        name, value = param.split('=', 1)
+        try:
+            parsed[name] = json.loads(value)
+        except ValueError:
+            parsed[name] = value
+    return parsed
+
+def build(args):
+    builddir = features.build_index(args.features, args.out,
+                                    ndim=args.ndim, random_state=args.seed,
+                                    backend=args.backend,
+                                    backend_params=parse_params(args.param),
+                                    dtype=args.dtype)
+    print('wrote index to {}'.format(builddir))
+
+def append(args):
+    builddir, n_added = features.append_index(args.features, args.out, args.new)
+    print('added {} vectors to the delta segment of {}'.format(n_added, builddir))
+    if args.compact and features.needs_compaction(builddir, args.compact_fraction):
+        start_compaction(args, builddir)
+
+def start_compaction(args, builddir):
+    """ run `compact` in a detached process that outlives this command """
+    import subprocess
+    log = os.path.join(os.path.dirname(builddir), 'compact.log')
+    with open(log, 'a') as f:
+        process = subprocess.Popen([sys.executable, '-m', 'uhcsdb.index', 'compact',
+                                    '--features', args.features, '--out', args.out],
+                                   stdout=f, stderr=subprocess.STDOUT, start_new_session=True)
+    print('delta segment is large; compacting in the background (pid {}, log {})'.format(
+        process.pid, log))
+
+def compact(args):
+    builddir, n_merged = features.compact_index(args.features, args.out)
+    print('merged {} delta vectors; serving {}'.format(n_merged, builddir))
+
+def graph(args):
+    builddir = features.index_path(args.out, args.features)
+    if builddir is None:
+        raise SystemExit('no index built for {}; run `build` first'.format(args.features))
+    meta = features.build_graph(builddir, k=args.k, n_jobs=args.jobs, memory_mb=args.memory_mb)
+    print('wrote {}-nearest neighbor graph for {} micrographs in {:.1f}s to {}'.format(
+        meta['graph_k'], meta['n_samples'], meta['graph_seconds'], builddir))
+
+def show(args):
+    builddir = features.index_path(args.out, args.features)
+    if builddir is None:
+        print('no index built for {}'.format(args.features))
+        return
+    with open(os.path.join(builddir, 'meta.json'), 'r') as f:
+        print(json.dumps(json.load(f), indent=2))
+
+def benchmark_backend(name, params, vectors, queries, k, truth):
+    """ build time, single-query latency, batch throughput and recall@k """
+    t0 = time.time()
+    backend = features.make_backend(name, params).fit(vectors)
+    build_seconds = time.time() - t0
+
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        backend.kneighbors(q[None, :], k)
+        latencies.append(time.perf_counter() - t0)
+    latencies = 1000 * np.array(latencies)
+
+    t0 = time.perf_counter()
+    _, results = backend.kneighbors(queries, k)
+    batch_seconds = time.perf_counter() - t0
+
+    hits = [len(set(r) & set(t)) for r, t in zip(results, truth)]
+    return dict(
+        backend=name,
+        params=params,
+        build_seconds=build_seconds,
+        latency_ms_mean=float(latencies.mean()),
+        latency_ms_p50=float(np.percentile(latencies, 50)),
+        latency_ms_p99=float(np.percentile(latencies, 99)),
+        batch_queries_per_second=len(queries) / batch_seconds,
+        recall_at_k=float(np.sum(hits)) / (k * len(queries))
+    )
+
+def backend_params(name, params):
+    """ the subset of params that a backend's constructor accepts """
+    accepted = inspect.signature(features.BACKENDS[name].__init__).parameters
+    return {key: value for key, value in params.items() if key in accepted}
+
+def bench(args):
+    builddir = features.index_path(args.out, args.features)
+    if builddir is None:
+        raise SystemExit('no index built for {}; run `build` first'.format(args.features))
+    vectors = np.asarray(features.load_index(builddir)['vectors'])
+
+    rng = np.random.RandomState(args.seed)
+    n_queries = min(args.queries, vectors.shape[0])
+    queries = vectors[rng.choice(vectors.shape[0], n_queries, replace=False)]
+
+    # exact results are the reference for recall
+    _, truth = features.make_backend('brute').fit(vectors).kneighbors(queries, args.k)
+
+    params = parse_params(args.param)
+    report = dict(
+        index=builddir,
+        n_samples=vectors.shape[0],
+        ndim=vectors.shape[1],
+        k=args.k,
+        n_queries=n_queries,
+        results=[benchmark_backend(name, backend_params(name, params),
+                                   vectors, queries, args.k, truth)
+                 for name in (args.backend or ['brute', 'ivf', 'quantized'])]
+    )
+    print(json.dumps(report, indent=2))
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--features', default=DEFAULT_FEATURES, help='hdf5 representation file')
+    common.add_argument('--out', default=DEFAULT_INDEX_PATH, help='index artifact directory')
+
+    parser = argparse.ArgumentParser(description='build the uhcsdb similarity search index')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', parents=[common], help='fit PCA and the neighbor model')
+    build_parser.add_argument('--ndim', type=int, default=64, help='number of PCA components')
+    build_parser.add_argument('--seed', type=int, default=0, help='random state for the PCA fit')
+    build_parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'],
+                              help='storage type of the reduced vectors')
+    build_parser.add_argument('--backend', default='brute', choices=sorted(features.BACKENDS),
+                              help='nearest neighbor backend')
+    build_parser.add_argument('--param', action='append', help='backend parameter, name=value')
+    build_parser.set_defaults(func=build)
+
+    bench_parser = subparsers.add_parser('bench', parents=[common],
+                                         help='compare backends against exact search')
+    bench_parser.add_argument('--backend', action='append', choices=sorted(features.BACKENDS),
+                              help='backend to benchmark (repeatable; default brute, ivf and quantized)')
+    bench_parser.add_argument('--param', action='append',
+                              help='backend parameter, name=value; passed to each backend that accepts it')
+    bench_parser.add_argument('-k', type=int, default=16, help='number of neighbors')
+    bench_parser.add_argument('--queries', type=int, default=1000, help='number of sampled queries')
+    bench_parser.add_argument('--seed', type=int, default=0, help='random state for query sampling')
+    bench_parser.set_defaults(func=bench)
+
+    append_parser = subparsers.add_parser('append', parents=[common],
+                                          help='add new micrographs using the current PCA basis')
+    append_parser.add_argument('--new', required=True,
+                               help='hdf5 file with feature vectors for the new micrographs')
+    append_parser.add_argument('--compact-fraction', type=float, default=features.COMPACT_FRACTION,
+                               help='compact in the background once the delta segment holds '
+                                    'more than this fraction of the main segment')
+    append_parser.add_argument('--no-compact', dest='compact', action='store_false',
+                               help='never start a background compaction')
+    append_parser.set_defaults(func=append)
+
+    compact_parser = subparsers.add_parser('compact', parents=[common],
+                                           help='fold appended micrographs into a new build')
+    compact_parser.set_defaults(func=compact)
+
+    graph_parser = subparsers.add_parser('graph', parents=[common],
+                                         help='precompute the exact neighbor graph for the current build')
+    graph_parser.add_argument('-k', type=int, default=32,
+                              help='neighbors stored per micrograph; queries for more fall back to live search')
+    graph_parser.add_argument('--memory-mb', type=int, default=1024,
+                              help='memory for distance tiles, shared by all worker threads')
+    graph_parser.add_argument('--jobs', type=int, default=None, help='worker threads (default: all cores)')
+    graph_parser.set_defaults(func=graph)
+
+    show_parser = subparsers.add_parser('show', parents=[common], help='print metadata for the current build')
+    show_parser.set_defaults(func=show)
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+""" lightweight in-process metrics with a prometheus text exposition
+
+cheap enough to leave on: observing a value is a bisect and a few additions under a lock.
+metrics are per process; under gunicorn each worker reports its own.
+"""
+import time
+import bisect
+import logging
+import threading
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+    def _render_value(self, labelvalues, value):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, labelvalues),
+                                 _format_value(value))]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    """ a settable value, or one computed at scrape time by a callback """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), callback=None):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.callback = callback
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def render(self):
+        if self.callback is not None:
+            value = self.callback()
+            if value is not None:
+                self.set(value)
+        return super(Gauge, self).render()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                # per-bucket counts, then sum and count
+                counts = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def _render_value(self, labelvalues, counts):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labels, labelvalues, [('le', _format_value(bound))])
+            lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+        labels = _format_labels(self.labels, labelvalues)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-2])))
+        lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+        return lines
+
+class _Timer(object):
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, *self.labelvalues)
+        _request_add(self.histogram.name, self.elapsed)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    'uhcsdb_request_duration_seconds', 'request latency by route',
+    labels=('endpoint', 'method', 'status')))
+request_sql_statements = registry.register(Histogram(
+    'uhcsdb_request_sql_statements', 'sql statements executed per request',
+    labels=('endpoint',), buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)))
+sql_seconds = registry.register(Histogram(
+    'uhcsdb_sql_statement_duration_seconds', 'sql statement execution time'))
+knn_query_seconds = registry.register(Histogram(
+    'uhcsdb_knn_query_duration_seconds', 'nearest neighbor search time',
+    labels=('kind',), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)))
+index_load_seconds = registry.register(Gauge(
+    'uhcsdb_index_load_duration_seconds', 'time to build or load the served search index',
+    labels=('mode',)))
+index_size = registry.register(Gauge(
+    'uhcsdb_index_vectors', 'number of vectors in the served search index'))
+feature_matrix_bytes = registry.register(Gauge(
+    'uhcsdb_feature_matrix_bytes', 'bytes held by the served reduced feature matrix'))
+
+
+# per-request accumulators, kept on flask.g when a request is active
+def _request_add(name, value):
+    if has_request_context():
+        setattr(g, '_metrics_' + name, getattr(g, '_metrics_' + name, 0) + value)
+
+def _request_get(name):
+    return getattr(g, '_metrics_' + name, 0)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['_metrics_start'].pop()
+    sql_seconds.observe(elapsed)
+    _request_add('sql_statements', 1)
+    _request_add('sql_seconds', elapsed)
+
+def init_app(app):
+    """ time every request, and log a breakdown of requests slower than SLOW_REQUEST_SECONDS """
+
+    @app.before_request
+    def start_request_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = getattr(g, '_metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'unmatched'
+        request_seconds.observe(elapsed, endpoint, request.method, response.status_code)
+        request_sql_statements.observe(_request_get('sql_statements'), endpoint)
+
+        slow = app.config.get('SLOW_REQUEST_SECONDS')
+        if slow and elapsed > slow:
+            logger.warning('slow request %s %s: %.3fs total, %d sql statements in %.3fs, knn %.3fs',
+                           request.method, request.full_path, elapsed,
+                           _request_get('sql_statements'), _request_get('sql_seconds'),
+                           _request_get(knn_query_seconds.name))
+        return response
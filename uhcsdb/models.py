@@ -38,11 +38,11 @@ class Sample(Base):
     __tablename__ = 'sample'
     sample_id = Column(Integer, primary_key=True)
     label = Column(String(250))
-    anneal_time = Column(Float)
+    anneal_time = Column(Float, index=True)
     anneal_time_unit = Column(String(16))
-    anneal_temperature = Column(Float)
+    anneal_temperature = Column(Float, index=True)
     anneal_temp_unit = Column(String(16))
-    cool_method = Column(String(16))
+    cool_method = Column(String(16), index=True)
     micrographs = relationship('Micrograph')
     
 class Micrograph(Base):
@@ -52,13 +52,13 @@ class Micrograph(Base):
     micron_bar =       Column(Float)
     micron_bar_units = Column(String(64))
     micron_bar_px =    Column(Integer)
-    magnification =    Column(Integer)
-    detector =         Column(String(16))
-    sample_key =        Column(Integer, ForeignKey('sample.sample_id'))
+    magnification =    Column(Integer, index=True)
+    detector =         Column(String(16), index=True)
+    sample_key =        Column(Integer, ForeignKey('sample.sample_id'), index=True)
     sample =           relationship('Sample', back_populates='micrographs')
     contributor_key =   Column(Integer, ForeignKey('user.user_id'))
     contributor =      relationship('User', back_populates='micrographs')
-    primary_microconstituent = Column(String(250))
+    primary_microconstituent = Column(String(250), index=True)
 
     def info(self):
         """ construct a dictionary to feed data to render_template """
@@ -89,6 +89,15 @@ class Micrograph(Base):
                     microconstituent=self.primary_microconstituent
         )
 
+def create_indexes(engine):
+    """ add any indexes declared on the models that the database lacks.
+
+    the distributed sqlite database predates some of these indexes.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 if __name__ == '__main__':
     engine = create_engine(dbpath)
 
@@ -0,0 +1,81 @@
+""" cached bibliography data for the /publications page
+
+pybtex parsing dominates the cost of that page, so parsed entries are cached
+per .bib file and only reparsed when the file's mtime changes.
+"""
+import os
+import time
+import threading
+
+_cache = {}
+_lock = threading.Lock()
+
+def author_list(entry):
+    authors = [' '.join(p.last_names) for p in entry.persons['author']]
+    firstauthors, lastauthor = authors[:-1], authors[-1]
+    alist = ', '.join(firstauthors)
+    alist += ', and {}'.format(lastauthor)
+    return alist
+
+def parse_publication_data(path):
+    """ use pybtex to display relevant publications """
+    import pybtex.database
+    pub_db = pybtex.database.parse_file(path)
+
+    publication_data = []
+    for key, entry in pub_db.entries.items():
+        pub = dict(entry.fields)
+        pub['authors'] = author_list(entry)
+        publication_data.append(pub)
+
+    return publication_data
+
+def load_publication_data(path):
+    """ parsed publication data for a .bib file, cached on (path, mtime) """
+    mtime = os.path.getmtime(path)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    publication_data = parse_publication_data(path)
+    with _lock:
+        _cache[path] = (mtime, publication_data)
+    return publication_data
+
+def version(paths):
+    """ cache key for anything derived from these .bib files """
+    return tuple(os.path.getmtime(path) for path in paths)
+
+class BibliographyWatcher(threading.Thread):
+    """ reparse .bib files in the background when they change.
+
+    requests then find fresh entries in the cache instead of paying for pybtex.
+    on_change is called with the list of changed paths after reparsing.
+    """
+
+    def __init__(self, paths, interval=30, on_change=None):
+        super(BibliographyWatcher, self).__init__(name='bibliography-watcher')
+        self.daemon = True
+        self.paths = list(paths)
+        self.interval = interval
+        self.on_change = on_change
+
+    def run(self):
+        while True:
+            changed = []
+            for path in self.paths:
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                cached = _cache.get(path)
+                if cached is None or cached[0] != mtime:
+                    try:
+                        load_publication_data(path)
+                    except Exception as e:
+                        print('could not parse {}: {}'.format(path, e))
+                        continue
+                    changed.append(path)
+            if changed and self.on_change is not None:
+                self.on_change(changed)
+            time.sleep(self.interval)
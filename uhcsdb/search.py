@@ -0,0 +1,273 @@
+""" metadata search over micrographs and their samples
+
+shared by the /api/micrographs endpoint and scripts/export_metadata.py.
+filters map onto indexed columns declared in models.py. FilterMasks
+evaluates the same filters against a search index's key order, for
+filtered similarity search.
+"""
+import io
+import csv
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import and_, or_
+
+from uhcsdb.models import Micrograph, Sample
+
+# output columns, in order; the sample id comes from the join key
+# so the micrograph and sample tables never contribute two 'id' columns
+COLUMNS = (
+    ('micrograph_id', Micrograph.micrograph_id),
+    ('path', Micrograph.path),
+    ('micron_bar', Micrograph.micron_bar),
+    ('micron_bar_units', Micrograph.micron_bar_units),
+    ('micron_bar_px', Micrograph.micron_bar_px),
+    ('magnification', Micrograph.magnification),
+    ('detector', Micrograph.detector),
+    ('primary_microconstituent', Micrograph.primary_microconstituent),
+    ('contributor_key', Micrograph.contributor_key),
+    ('sample_key', Micrograph.sample_key),
+    ('label', Sample.label),
+    ('anneal_time', Sample.anneal_time),
+    ('anneal_time_unit', Sample.anneal_time_unit),
+    ('anneal_temperature', Sample.anneal_temperature),
+    ('anneal_temp_unit', Sample.anneal_temp_unit),
+    ('cool_method', Sample.cool_method),
+)
+COLUMN_NAMES = [name for name, column in COLUMNS]
+
+# multi-valued equality filters
+CATEGORICAL = {
+    'microconstituent': Micrograph.primary_microconstituent,
+    'detector': Micrograph.detector,
+    'magnification': Micrograph.magnification,
+    'cool_method': Sample.cool_method,
+}
+
+# range filters: (name_min, name_max) bound the column
+RANGES = ('anneal_temperature', 'anneal_time')
+
+# output column holding each categorical filter's value
+CATEGORICAL_COLUMNS = {
+    'microconstituent': 'primary_microconstituent',
+    'detector': 'detector',
+    'magnification': 'magnification',
+    'cool_method': 'cool_method',
+}
+
+def parse_magnification(value):
+    """ magnification as an integer, None if blank.
+
+    the catalog stores it as text like '1964X' or '982x'; raises ValueError
+    for anything else that is not a number.
+    """
+    if value is None:
+        return None
+    value = str(value).strip().rstrip('xX').strip()
+    if not value:
+        return None
+    return int(value)
+
+def _stored_values(name, values):
+    """ every form a filter value may be stored in, so IN keeps using the column index """
+    if name == 'magnification':
+        return [v for m in values for v in (m, '{}x'.format(m), '{}X'.format(m))]
+    return values
+
+def parse_filters(args):
+    """ read search filters from a werkzeug MultiDict (or a plain dict of lists).
+
+    magnification values are compared as numbers ('1964', '1964x' and
+    '1964X' are all 1964). raises ValueError on malformed range bounds or
+    magnifications.
+    """
+    getlist = args.getlist if hasattr(args, 'getlist') else (lambda k: args.get(k) or [])
+    filters = {}
+    for name in CATEGORICAL:
+        values = [v for value in getlist(name) for v in str(value).split(',') if v]
+        if name == 'magnification':
+            values = [m for m in map(parse_magnification, values) if m is not None]
+        if values:
+            filters[name] = values
+    for name in RANGES:
+        for bound in ('min', 'max'):
+            key = '{}_{}'.format(name, bound)
+            values = getlist(key)
+            if values:
+                filters[key] = float(values[-1])
+    return filters
+
+def _anneal_time_range(lo, hi):
+    """ anneal_time bounds in minutes; stored times are in hours when the unit is 'H'.
+
+    written as two plain ranges so sqlite can still use the anneal_time index.
+    """
+    def bounded(scale):
+        clauses = []
+        if lo is not None:
+            clauses.append(Sample.anneal_time >= lo / scale)
+        if hi is not None:
+            clauses.append(Sample.anneal_time <= hi / scale)
+        return and_(*clauses)
+
+    return or_(and_(Sample.anneal_time_unit == 'H', bounded(60.0)),
+               and_(or_(Sample.anneal_time_unit == None, Sample.anneal_time_unit != 'H'),
+                    bounded(1.0)))
+
+def metadata_query(db, filters=None, columns=None):
+    """ a column-level query over the micrograph/sample join, ordered by micrograph_id """
+    filters = filters or {}
+    names = columns or COLUMN_NAMES
+    lookup = dict(COLUMNS)
+    unknown = [name for name in names if name not in lookup]
+    if unknown:
+        raise ValueError('unknown columns: {}'.format(', '.join(unknown)))
+
+    q = (db.query(*[lookup[name].label(name) for name in names])
+         .select_from(Micrograph)
+         .outerjoin(Sample, Micrograph.sample_key == Sample.sample_id))
+
+    for name, column in CATEGORICAL.items():
+        if name in filters:
+            q = q.filter(column.in_(_stored_values(name, filters[name])))
+
+    t_lo, t_hi = filters.get('anneal_temperature_min'), filters.get('anneal_temperature_max')
+    if t_lo is not None:
+        q = q.filter(Sample.anneal_temperature >= t_lo)
+    if t_hi is not None:
+        q = q.filter(Sample.anneal_temperature <= t_hi)
+
+    a_lo, a_hi = filters.get('anneal_time_min'), filters.get('anneal_time_max')
+    if a_lo is not None or a_hi is not None:
+        q = q.filter(_anneal_time_range(a_lo, a_hi))
+
+    return q.order_by(Micrograph.micrograph_id)
+
+def iter_ndjson(rows, names):
+    for row in rows:
+        yield json.dumps(dict(zip(names, row))) + '\n'
+
+def iter_csv(rows, names, chunk_size=500):
+    """ csv text in chunks of rows, header first """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(names)
+    for n, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if n % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+class FilterMasks(object):
+    """ metadata filters as boolean masks aligned with a search index's keys.
+
+    one mask per value of each categorical filter is built up front from a
+    single metadata query; range filters compare against per-key arrays
+    (anneal time converted to minutes, nan where unknown). combined masks
+    are cached per filter set, so repeated filtered searches reuse them.
+    semantics match metadata_query: values within a filter are or'ed,
+    filters are and'ed, and unknown values never match.
+    """
+
+    # ids per IN (...) clause when only_keys restricts the query
+    chunk_size = 500
+
+    def __init__(self, db, keys, cache_size=64, only_keys=False):
+        """ only_keys queries just the rows of keys instead of scanning the
+        whole catalog; cheaper for small key sets such as a delta segment """
+        keys = np.asarray(keys).tolist()
+        position = {key: row for row, key in enumerate(keys)}
+        self.size = len(position)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        categorical = list(CATEGORICAL_COLUMNS.items())
+        names = (['micrograph_id'] + [column for name, column in categorical]
+                 + ['anneal_temperature', 'anneal_time', 'anneal_time_unit'])
+        values = {name: {} for name, column in categorical}
+        self.anneal_temperature = np.full(self.size, np.nan)
+        self.anneal_time = np.full(self.size, np.nan)
+
+        if only_keys:
+            records = (record for start in range(0, len(keys), self.chunk_size)
+                       for record in metadata_query(db, columns=names).filter(
+                           Micrograph.micrograph_id.in_(keys[start:start+self.chunk_size])))
+        else:
+            records = metadata_query(db, columns=names)
+
+        for record in records:
+            record = dict(zip(names, record))
+            row = position.get(record['micrograph_id'])
+            if row is None:
+                continue
+            for name, column in categorical:
+                value = self._value(name, record[column])
+                if value is not None:
+                    values[name].setdefault(value, []).append(row)
+            if record['anneal_temperature'] is not None:
+                self.anneal_temperature[row] = record['anneal_temperature']
+            if record['anneal_time'] is not None:
+                scale = 60.0 if record['anneal_time_unit'] == 'H' else 1.0
+                self.anneal_time[row] = record['anneal_time'] * scale
+
+        self.masks = {}
+        for name, rows_by_value in values.items():
+            self.masks[name] = {}
+            for value, rows in rows_by_value.items():
+                mask = np.zeros(self.size, dtype=bool)
+                mask[rows] = True
+                self.masks[name][value] = mask
+
+    @staticmethod
+    def _value(name, value):
+        """ a catalog value as parse_filters reads the same filter value """
+        if name == 'magnification':
+            try:
+                return parse_magnification(value)
+            except ValueError:
+                return None
+        return None if value is None else str(value)
+
+    def mask(self, filters):
+        """ the combined mask for parse_filters output; None when there are no filters """
+        if not filters:
+            return None
+        key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                           for name, value in filters.items()))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        mask = np.ones(self.size, dtype=bool)
+        for name in CATEGORICAL:
+            if name in filters:
+                selected = np.zeros(self.size, dtype=bool)
+                for value in filters[name]:
+                    if value in self.masks[name]:
+                        selected |= self.masks[name][value]
+                mask &= selected
+
+        # comparisons with nan are False: unknown values never match a range
+        with np.errstate(invalid='ignore'):
+            for name in RANGES:
+                column = getattr(self, name)
+                lo = filters.get('{}_min'.format(name))
+                hi = filters.get('{}_max'.format(name))
+                if lo is not None:
+                    mask &= column >= lo
+                if hi is not None:
+                    mask &= column <= hi
+
+        mask.flags.writeable = False
+        with self._lock:
+            self._cache[key] = mask
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return mask
@@ -0,0 +1,111 @@
+""" measure the flask app's cold start: import time and memory per package
+
+python -m uhcsdb.startup
+python -m uhcsdb.startup --budget-ms 1000 --budget-mb 150 --json
+
+each measurement imports the app in a fresh interpreter, like a gunicorn worker boot.
+exits nonzero when a budget is exceeded.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# runs in a fresh interpreter: wall time and peak rss for importing the app
+TIMING_PROBE = '''
+import json, resource, time
+t0 = time.perf_counter()
+import uhcsdb
+uhcsdb.app
+print(json.dumps(dict(seconds=time.perf_counter() - t0,
+                      maxrss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+'''
+
+# memory allocated while importing the app, attributed to the module whose code allocated it
+MEMORY_PROBE = '''
+import json, sys, tracemalloc
+tracemalloc.start()
+import uhcsdb
+uhcsdb.app
+snapshot = tracemalloc.take_snapshot()
+files = {getattr(m, '__file__', None): name for name, m in list(sys.modules.items())}
+memory = {}
+for stat in snapshot.statistics('filename'):
+    filename = stat.traceback[0].filename
+    name = files.get(filename, filename)
+    memory[name] = memory.get(name, 0) + stat.size
+print(json.dumps(memory))
+'''
+
+def run_probe(code, *flags):
+    proc = subprocess.run([sys.executable] + list(flags) + ['-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, cwd=os.getcwd())
+    if proc.returncode != 0:
+        raise SystemExit('importing the app failed:\n' + proc.stderr)
+    return proc
+
+def parse_importtime(stderr):
+    """ self and cumulative import time in microseconds from python -X importtime """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = dict(self_us=int(self_us), cumulative_us=int(cumulative_us))
+    return modules
+
+def by_package(values):
+    """ sum per-module values by top-level package """
+    totals = {}
+    for name, value in values.items():
+        package = name.split('.')[0] if not os.path.isabs(name) else '<other>'
+        totals[package] = totals.get(package, 0) + value
+    return totals
+
+def profile():
+    timing = json.loads(run_probe(TIMING_PROBE).stdout.strip().splitlines()[-1])
+    imports = parse_importtime(run_probe(TIMING_PROBE, '-X', 'importtime').stderr)
+    memory = json.loads(run_probe(MEMORY_PROBE).stdout.strip().splitlines()[-1])
+
+    import_ms = by_package({name: m['self_us'] / 1000. for name, m in imports.items()})
+    memory_mb = by_package({name: size / 1024.**2 for name, size in memory.items()})
+    return dict(
+        import_seconds=timing['seconds'],
+        maxrss_mb=timing['maxrss_kb'] / 1024.,
+        n_modules=len(imports),
+        import_ms_by_package=import_ms,
+        memory_mb_by_package=memory_mb,
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='profile the uhcsdb web app cold start')
+    parser.add_argument('--top', type=int, default=20, help='packages to list')
+    parser.add_argument('--budget-ms', type=float, help='maximum import time')
+    parser.add_argument('--budget-mb', type=float, help='maximum peak rss after import')
+    parser.add_argument('--json', action='store_true', help='print the full report as json')
+    args = parser.parse_args(argv)
+
+    report = profile()
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print('import: {:.0f} ms, peak rss: {:.1f} MB, {} modules'.format(
+            1000 * report['import_seconds'], report['maxrss_mb'], report['n_modules']))
+        print('{:<24} {:>10} {:>10}'.format('package', 'self ms', 'alloc MB'))
+        ranked = sorted(report['import_ms_by_package'].items(), key=lambda kv: -kv[1])
+        for package, ms in ranked[:args.top]:
+            mb = report['memory_mb_by_package'].get(package, 0)
+            print('{:<24} {:>10.1f} {:>10.2f}'.format(package, ms, mb))
+
+    over = []
+    if args.budget_ms is not None and 1000 * report['import_seconds'] > args.budget_ms:
+        over.append('import time {:.0f} ms > {:.0f} ms'.format(1000 * report['import_seconds'], args.budget_ms))
+    if args.budget_mb is not None and report['maxrss_mb'] > args.budget_mb:
+        over.append('peak rss {:.1f} MB > {:.1f} MB'.format(report['maxrss_mb'], args.budget_mb))
+    if over:
+        raise SystemExit('cold-start budget exceeded: ' + '; '.join(over))
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,22 @@
 # all the imports
+# heavy dependencies (bokeh, pybtex, h5py, sklearn) are imported
+# inside the code paths that use them, to keep worker boot fast;
+# `python -m uhcsdb.startup` reports the import cost of this module.
 import os
-import re
 import sys
 import glob
-import time
-import uuid
-import atexit
-import requests
-import subprocess
-import pandas as pd
-import seaborn as sns
-import pybtex.database
-from datetime import datetime
-from contextlib import closing
-from numpy import array, random
+import json
+import threading
 from os.path import abspath, dirname, join
 
-from bokeh.client import pull_session
-from bokeh.embed import autoload_server
+import numpy as np
 
 from werkzeug.contrib.fixers import ProxyFix
-from flask import (Flask, request, session, g, redirect, url_for, send_file,
-                   abort, render_template, render_template_string, flash, current_app)
+from flask import (Flask, Response, request, session, g, redirect, url_for, send_file,
+                   abort, render_template, render_template_string, flash, current_app,
+                   stream_with_context)
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, contains_eager
+from sqlalchemy.orm import joinedload
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
@@ -38,6 +30,19 @@ UPLOAD_FOLDER = join('uhcsdb', MICROGRAPH_PATH)
 EXTRACT_PATH = join('static', 'pdf_stage')
 PDF_STAGE = join('uhcsdb', EXTRACT_PATH)
 ALLOWED_EXTENSIONS = set(['pdf', 'png', 'jpg', 'jpeg', 'gif', 'tif'])
+REPRESENTATION_PATH = 'uhcsdb/static/representations'
+REPRESENTATION = 'vgg16_multiscale_block5_conv3-vlad-32.h5'
+INDEX_PATH = 'uhcsdb/static/index'
+# None serves whichever backend `python -m uhcsdb.index build --backend` persisted
+# (brute force when no build exists). naming one of features.BACKENDS, 'brute',
+# 'ivf', 'quantized', 'sharded' or 'sklearn', refits it in every worker at load,
+# e.g. SEARCH_BACKEND = 'quantized' with SEARCH_BACKEND_PARAMS = {'dtype': 'int8'},
+# or SEARCH_BACKEND = 'sharded' with SEARCH_BACKEND_PARAMS = {'n_shards': 8}
+SEARCH_BACKEND = None
+N_RESULTS = 16
+MAX_BATCH_IDS = 1024
+MAX_BATCH_RESULTS = 256
+SEARCH_STREAM_CHUNK = 1000
 
 def load_secret_key():
     pardir = os.path.dirname(__file__)
@@ -48,6 +53,28 @@ def load_secret_key():
 app.config.update(dict(
     DATABASE=SQLALCHEMY_DATABASE_URI,
     MICROGRAPH_PATH = MICROGRAPH_PATH,
+    REPRESENTATION_PATH=REPRESENTATION_PATH,
+    REPRESENTATION=REPRESENTATION,
+    INDEX_PATH=INDEX_PATH,
+    SEARCH_BACKEND=SEARCH_BACKEND,
+    SEARCH_BACKEND_PARAMS={},
+    INDEX_WATCH_INTERVAL=60,
+    INDEX_MEMORY_BUDGET_MB=1024,
+    INDEX_WAIT_SECONDS=2,
+    INDEX_RETRY_AFTER=5,
+    INDEX_LOAD_RETRY_SECONDS=30,
+    FILTER_MASK_CACHE_SIZE=8,
+    N_RESULTS=N_RESULTS,
+    MAX_BATCH_IDS=MAX_BATCH_IDS,
+    MAX_BATCH_RESULTS=MAX_BATCH_RESULTS,
+    SEARCH_STREAM_CHUNK=SEARCH_STREAM_CHUNK,
+    DATABASE_ENGINE_OPTIONS=dict(pool_size=5, max_overflow=10),
+    PUBLICATIONS_PRERENDER=True,
+    PUBLICATIONS_WATCH_INTERVAL=30,
+    STATIC_IMAGE_MAX_AGE=365*24*3600,
+    RESPONSE_CACHE_SIZE=2048,
+    RESPONSE_CACHE_TTL=3600,
+    SLOW_REQUEST_SECONDS=0,
     DEBUG=False,
     SECRET_KEY=load_secret_key(),
 ))
@@ -58,46 +85,262 @@ _cwd = dirname(abspath(__file__))
 
 print(app.config)
 
-from . import features
+from . import features, database, images, search, metrics
+from .cache import ResponseCache, cached_view
+from . import publications as bibliography
 from .models import Base, User, Collection, Sample, Micrograph
 
-from uhcsdb import features
+from uhcsdb import features, database, images, search, metrics
+from uhcsdb.cache import ResponseCache, cached_view
+from uhcsdb import publications as bibliography
 from uhcsdb.models import Base, User, Collection, Sample, Micrograph
 
-@app.before_first_request
-def build_search_tree():
-    print('building search tree...')
-    features.build_search_tree('uhcsdb/static/representations',
-                               featurename='vgg16_multiscale_block5_conv3-vlad-32.h5'
+metrics.init_app(app)
+metrics.index_size.callback = lambda: len(features.index) if features.index else None
+metrics.feature_matrix_bytes.callback = lambda: features.index.nbytes if features.index else None
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+_image_manifest = {}
+
+def image_manifest():
+    """ the derived image manifest, reloaded when its file changes """
+    path = os.path.join(app.static_folder, images.MANIFEST)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    if _image_manifest.get('mtime') != mtime:
+        _image_manifest.update(mtime=mtime, images=images.load_manifest(app.static_folder))
+    return _image_manifest['images']
+
+def static_image_record(url):
+    """ manifest record for a /static image url, if there is one """
+    prefix = app.static_url_path + '/'
+    if not url.startswith(prefix):
+        return None
+    return image_manifest().get(url[len(prefix):].split('?')[0])
+
+@app.template_filter('versioned')
+def versioned(url):
+    """ append the content hash so the url changes whenever the image does """
+    record = static_image_record(url)
+    if record is None:
+        return url
+    return '{}?v={}'.format(url, record['sha1'][:12])
+
+@app.after_request
+def cache_static_images(response):
+    """ content-hash etags for derived images.
+
+    only urls carrying the current ?v= hash (see versioned) are cached for
+    STATIC_IMAGE_MAX_AGE; unversioned urls, e.g. the explorer's thumbnails,
+    are revalidated against the etag on every use.
+    """
+    record = static_image_record(request.path)
+    if record is not None and response.status_code in (200, 304):
+        response.set_etag(record['sha1'])
+        response.cache_control.public = True
+        if request.args.get('v') == record['sha1'][:12]:
+            response.cache_control.max_age = app.config['STATIC_IMAGE_MAX_AGE']
+        else:
+            response.cache_control.no_cache = True
+        response.make_conditional(request)
+    return response
+
+def load_default_index():
+    # prefer the artifacts written by `python -m uhcsdb.index build`
+    if features.load_search_index(app.config['INDEX_PATH'], app.config['REPRESENTATION'],
+                                  backend=app.config['SEARCH_BACKEND'],
+                                  backend_params=app.config['SEARCH_BACKEND_PARAMS'],
+                                  prepare=prepare_filter_masks):
+        # pick up builds written later, e.g. by `python -m uhcsdb.index append`
+        if app.config['INDEX_WATCH_INTERVAL']:
+            features.watch_index(app.config['INDEX_PATH'], app.config['REPRESENTATION'],
+                                 interval=app.config['INDEX_WATCH_INTERVAL'],
+                                 prepare=prepare_filter_masks,
+                                 backend=app.config['SEARCH_BACKEND'],
+                                 backend_params=app.config['SEARCH_BACKEND_PARAMS'])
+        return
+
+    print('no prebuilt index found; building search tree...')
+    features.build_search_tree(app.config['REPRESENTATION_PATH'],
+                               featurename=app.config['REPRESENTATION'],
+                               backend=app.config['SEARCH_BACKEND'],
+                               backend_params=app.config['SEARCH_BACKEND_PARAMS']
     )
+    prepare_filter_masks(features.index)
     # features.build_search_tree(app.config['DATADIR'])
 
-def connect_db(dbpath):
-    engine = create_engine('sqlite:///' + dbpath)
-    Base.metadata.bind = engine
-    dbSession = sessionmaker(bind=engine)
-    db = dbSession()
-    return db
+# the default index loads in the background so that routes which don't
+# search (entries, publications, ...) serve immediately after worker start.
+# with gunicorn --preload, call index_warmup.start() from a post_fork hook
+# to begin loading before the first request reaches the worker.
+index_warmup = features.IndexWarmup(load_default_index,
+                                    retry_seconds=app.config['INDEX_LOAD_RETRY_SECONDS'])
+
+@app.before_request
+def start_index_warmup():
+    index_warmup.start()
+
+def require_index(warmup=index_warmup):
+    """ wait up to INDEX_WAIT_SECONDS for an index load (by default the
+    default index), else 503 with Retry-After """
+    if warmup.wait(app.config['INDEX_WAIT_SECONDS']):
+        return
+    if warmup.state == 'failed':
+        message = 'search index unavailable'
+    else:
+        message = 'search index warming up; retry shortly'
+    response = Response(message + '\n', status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(app.config['INDEX_RETRY_AFTER'])})
+    abort(response)
+
+@app.route('/healthz')
+def healthz():
+    """ liveness: the worker answers requests """
+    return Response(json.dumps(dict(status='ok')), mimetype='application/json')
+
+@app.route('/readyz')
+def readyz():
+    """ readiness: 200 once the default search index is live, 503 until then """
+    status = index_warmup.status()
+    code = 200 if index_warmup.ready and status['state'] == 'ready' else 503
+    return Response(json.dumps(status), status=code, mimetype='application/json')
+
+def load_representation_index(featurename):
+    """ search index for any representation: prebuilt if available, else fit now.
+    runs in a background thread started by search_indexes.warmup """
+    search_index = features.open_search_index(app.config['INDEX_PATH'], featurename,
+                                              backend=app.config['SEARCH_BACKEND'],
+                                              backend_params=app.config['SEARCH_BACKEND_PARAMS'])
+    if search_index is None:
+        search_index = features.create_search_index(app.config['REPRESENTATION_PATH'], featurename,
+                                                    backend=app.config['SEARCH_BACKEND'],
+                                                    backend_params=app.config['SEARCH_BACKEND_PARAMS'])
+    prepare_filter_masks(search_index)
+    return search_index
+
+search_indexes = features.IndexRegistry(
+    load_representation_index,
+    max_bytes=app.config['INDEX_MEMORY_BUDGET_MB'] * 1024**2,
+    default=app.config['REPRESENTATION'],
+    retry_seconds=app.config['INDEX_LOAD_RETRY_SECONDS']
+)
+
+def available_representations():
+    """ representation files that can be searched """
+    pattern = os.path.join(app.config['REPRESENTATION_PATH'], '*.h5')
+    return sorted(map(os.path.basename, glob.glob(pattern)))
+
+def requested_index():
+    """ search index for the ?representation= query argument (default representation if absent) """
+    representation = request.args.get('representation')
+    if representation is not None and representation not in available_representations():
+        abort(404)
+    if representation is None or representation == app.config['REPRESENTATION']:
+        require_index()
+        return representation, features.index
+
+    search_index = search_indexes.get(representation)
+    if search_index is None:
+        # load in the background rather than converting and fitting in
+        # this request; 503 with Retry-After until the load is done
+        warmup = search_indexes.warmup(representation)
+        require_index(warmup)
+        search_index = warmup.result
+    return representation, search_index
+
+# FilterMasks per index segment. the main segment's masks are keyed on its
+# build, so attaching a new delta generation only queries the delta's rows.
+# the index loaders build both before an index is served (prepare_filter_masks).
+_filter_masks = {}
+_filter_masks_lock = threading.Lock()
+
+def segment_masks(search_index):
+    """ (main, delta) FilterMasks for search_index; delta is None without a delta segment """
+    dbversion = database.version(app.config['DATABASE'])
+    segments = [(('main', search_index.base_version, dbversion), search_index.main_keys, False)]
+    if len(search_index.delta_keys):
+        segments.append((('delta', search_index.version, dbversion), search_index.delta_keys, True))
+
+    masks = []
+    with _filter_masks_lock:
+        for key, keys, only_keys in segments:
+            if key not in _filter_masks:
+                with database.session_scope(app.config['DATABASE'],
+                                            **app.config.get('DATABASE_ENGINE_OPTIONS', {})) as db:
+                    segment = search.FilterMasks(db, keys, only_keys=only_keys)
+                if len(_filter_masks) >= app.config['FILTER_MASK_CACHE_SIZE']:
+                    _filter_masks.clear()
+                _filter_masks[key] = segment
+            masks.append(_filter_masks[key])
+    return masks[0], masks[1] if len(masks) > 1 else None
+
+def prepare_filter_masks(search_index):
+    """ build search_index's filter masks ahead of its first filtered query """
+    try:
+        segment_masks(search_index)
+    except Exception as e:
+        # filtered queries build them on demand instead
+        print('could not precompute filter masks: {!r}'.format(e))
+
+def filter_mask(search_index, filters):
+    """ combined metadata mask over search_index's keys; None when unfiltered """
+    if not filters:
+        return None
+    main, delta = segment_masks(search_index)
+    if delta is None:
+        return main.mask(filters)
+    return np.concatenate((main.mask(filters), delta.mask(filters)))
+
+def filter_args(filters):
+    """ query arguments that reproduce parsed filters, e.g. for links """
+    return {name: ','.join(map(str, value)) if isinstance(value, list) else value
+            for name, value in filters.items()}
+
+db_session = database.init_app(app)
 
 def get_db():
-    if not hasattr(g, '_database'):
-        g._database = connect_db(app.config['DATABASE'])
-    return g._database
-
-def paginate(results, page, PER_PAGE):
-    start = (page-1)*PER_PAGE
-    if start < 0 or start > len(results):
-        return []
-    end = min(start + PER_PAGE, len(results))
-
+    return db_session()
+
+_page_index_cache = {}
+
+def page_index(db, labels, per_page):
+    """ total count and the first micrograph_id on each page.
+
+    one id-only index scan, cached until the database file changes.
+    """
+    cache_key = (frozenset(labels), per_page)
+    version = database.version(app.config['DATABASE'])
+    cached = _page_index_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+
+    ids = (db.query(Micrograph.micrograph_id)
+           .filter(Micrograph.primary_microconstituent.in_(labels))
+           .order_by(Micrograph.micrograph_id)
+           )
+    count, boundaries = 0, []
+    for (m_id,) in ids.yield_per(1000):
+        if count % per_page == 0:
+            boundaries.append(m_id)
+        count += 1
+
+    _page_index_cache[cache_key] = (version, count, boundaries)
+    return count, boundaries
+
+def paginate(page, n_pages):
     page_data = {'prev_num': page - 1, 'next_num': page + 1,
                  'has_prev': True, 'has_next': True}
     if page_data['prev_num'] <= 0:
         page_data['has_prev'] = False
-    if end >= len(results):
+    if page >= n_pages:
         page_data['has_next'] = False
 
-    return results[start:end], page_data
+    return page_data
 
 ENTRIES_PER_PAGE = 24
 @app.route('/')
@@ -111,37 +354,193 @@ def entries(page=1):
          'pearlite', 'pearlite+spheroidite', 'pearlite+widmanstatten'
     }
     db = get_db()
-    q = (db.query(Micrograph)
-         .filter(Micrograph.primary_microconstituent.in_(unique_labels))
-         )
-    page_results, page_data = paginate(q.all(), page, ENTRIES_PER_PAGE)
-    page_entries = [entry.info() for entry in page_results]
-
+    count, boundaries = page_index(db, unique_labels, ENTRIES_PER_PAGE)
+    if page < 1 or page > max(1, len(boundaries)):
+        abort(404)
+
+    page_entries = []
+    if boundaries:
+        # keyset pagination: bound the page by its first id and the next page's,
+        # so sqlite never reads (and sorts) matching rows beyond this page
+        q = (db.query(Micrograph)
+             .options(joinedload(Micrograph.sample))
+             .filter(Micrograph.primary_microconstituent.in_(unique_labels))
+             .filter(Micrograph.micrograph_id >= boundaries[page-1])
+             )
+        if page < len(boundaries):
+            q = q.filter(Micrograph.micrograph_id < boundaries[page])
+        q = q.order_by(Micrograph.micrograph_id).limit(ENTRIES_PER_PAGE)
+        page_entries = [entry.info() for entry in q]
+
+    page_data = paginate(page, len(boundaries))
+    page_data.update(page=page, n_pages=max(1, len(boundaries)), total=count)
     return render_template('show_entries.html', entries=page_entries, pg=page_data)
 
+response_cache = ResponseCache(max_entries=app.config['RESPONSE_CACHE_SIZE'],
+                               ttl=app.config['RESPONSE_CACHE_TTL'])
+
+def catalog_version():
+    """ changes whenever the metadata store does """
+    return database.version(app.config['DATABASE'])
+
+def query_version():
+    """ changes whenever the metadata store or the search index for this
+    request's ?representation= does (None while that index is not loaded) """
+    representation = request.args.get('representation')
+    if representation is None or representation == app.config['REPRESENTATION']:
+        search_index = features.index
+    else:
+        search_index = search_indexes.get(representation)
+    return (catalog_version(), search_index.version if search_index is not None else None)
+
 @app.route('/micrograph/<int:entry_id>')
+@cached_view(response_cache, catalog_version)
 def show_entry(entry_id):
     db = get_db()
     entry = db.query(Micrograph).filter(Micrograph.micrograph_id == entry_id).first()
+    if entry is None:
+        abort(404)
     return render_template('show_entry.html', entry=entry.info(), author=entry.contributor.info())
 
+def load_micrographs(db, micrograph_ids):
+    """ fetch micrographs with their sample and contributor in one query.
+
+    results come back in the order of micrograph_ids.
+    """
+    micrograph_ids = list(micrograph_ids)
+    q = (db.query(Micrograph)
+         .options(joinedload(Micrograph.sample), joinedload(Micrograph.contributor))
+         .filter(Micrograph.micrograph_id.in_(micrograph_ids))
+         )
+    by_id = {entry.micrograph_id: entry for entry in q}
+    return [by_id[m_id] for m_id in micrograph_ids if m_id in by_id]
+
 @app.route('/visual_query/<int:entry_id>')
+@cached_view(response_cache, query_version)
 def visual_query(entry_id):
+    """ similar micrographs; accepts the /api/micrographs filters, e.g.
+    /visual_query/12?microconstituent=martensite&anneal_temperature_min=900
+    """
     db = get_db()
-    query = db.query(Micrograph).filter(Micrograph.micrograph_id == entry_id).first()
-    author = query.contributor
-    scores, nearest = features.query(entry_id)
-    # write a single query and sort results on feature-space distance after
-    # entries = db.query(Micrograph).filter(Micrograph.id.in_(nearest)).all()
-    # write an individual query for each result -- won't scale
-    entries = map(db.query(Micrograph).get, nearest)
-    results = [entry.info() for entry in entries]
-    results = zip(results, scores)
+    try:
+        filters = search.parse_filters(request.args)
+    except ValueError:
+        abort(400)
+    representation, search_index = requested_index()
+    try:
+        scores, nearest = features.query(entry_id, n_results=app.config['N_RESULTS'],
+                                         search_index=search_index,
+                                         mask=filter_mask(search_index, filters))
+    except KeyError:
+        abort(404)
+    nearest = list(nearest)
+
+    # hydrate the query and all neighbors in one round trip,
+    # then restore feature-space order
+    entries = load_micrographs(db, [entry_id] + nearest)
+    if not entries or entries[0].micrograph_id != entry_id:
+        abort(404)
+    query, entries = entries[0], entries[1:]
+
+    score_by_id = dict(zip(nearest, scores))
+    results = [(entry.info(), score_by_id[entry.micrograph_id]) for entry in entries]
     return render_template('query_results.html', query=query.info(),
-                           author=author.info(), results=results)
+                           author=query.contributor.info(), results=results,
+                           representation=representation or app.config['REPRESENTATION'],
+                           representations=available_representations(),
+                           filters=filter_args(filters))
+
+def parse_ids(value):
+    """ parse a comma-separated list of integer ids """
+    try:
+        return [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        abort(400)
+
+@app.route('/api/neighbors', methods=['GET', 'POST'])
+def api_neighbors():
+    """ batched similarity search, streamed as newline-delimited json.
+
+    GET /api/neighbors?ids=1,2,3&k=32&microconstituent=martensite
+    POST /api/neighbors with a json body {"ids": [1, 2, 3], "k": 32,
+                                          "filters": {"anneal_temperature_min": 900}}
+    either form accepts ?representation=<feature file> to search another representation.
+    filters are those of /api/micrographs; neighbors are restricted to matching micrographs.
+    """
+    if request.method == 'POST':
+        body = request.get_json(force=True, silent=True)
+        # invalid JSON, or a list or scalar where an object is expected
+        if not isinstance(body, dict):
+            abort(400)
+        ids, k = body.get('ids', []), body.get('k', app.config['N_RESULTS'])
+        if not isinstance(ids, list):
+            abort(400)
+        try:
+            ids, k = [int(i) for i in ids], int(k)
+            filters = search.parse_filters(
+                {name: value if isinstance(value, list) else [value]
+                 for name, value in dict(body.get('filters') or {}).items()})
+        except (TypeError, ValueError):
+            abort(400)
+    else:
+        ids = parse_ids(request.args.get('ids', ''))
+        k = request.args.get('k', app.config['N_RESULTS'], type=int)
+        try:
+            filters = search.parse_filters(request.args)
+        except ValueError:
+            abort(400)
+
+    if not ids or len(ids) > app.config['MAX_BATCH_IDS']:
+        abort(400)
+    k = max(1, min(k, app.config['MAX_BATCH_RESULTS']))
+
+    representation, search_index = requested_index()
+    batch = features.batch_query(ids, n_results=k, search_index=search_index,
+                                 mask=filter_mask(search_index, filters))
+
+    def generate():
+        for entry_id, distances, neighbors in batch:
+            if neighbors is None:
+                record = dict(micrograph_id=entry_id, error='not found')
+            else:
+                record = dict(micrograph_id=entry_id,
+                              neighbors=neighbors.tolist(),
+                              distances=[round(float(d), 4) for d in distances])
+            yield json.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/micrographs')
+def api_micrographs():
+    """ search micrograph metadata; streams ndjson (default) or csv.
+
+    /api/micrographs?microconstituent=martensite&anneal_temperature_min=900&format=csv
+    filters: microconstituent, detector, magnification, cool_method (repeatable or
+    comma-separated; magnification with or without the x, e.g. 1964 or 1964x),
+    anneal_temperature_min/max (C), anneal_time_min/max (minutes);
+    columns selects output columns, limit caps the number of rows.
+    """
+    try:
+        filters = search.parse_filters(request.args)
+        columns = [c for c in request.args.get('columns', '').split(',') if c] or None
+        q = search.metadata_query(get_db(), filters, columns)
+    except ValueError as e:
+        return Response(json.dumps(dict(error=str(e))), status=400, mimetype='application/json')
+
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        q = q.limit(max(limit, 0))
+
+    names = columns or search.COLUMN_NAMES
+    rows = q.yield_per(app.config['SEARCH_STREAM_CHUNK'])
+    if request.args.get('format', 'ndjson') == 'csv':
+        return Response(stream_with_context(search.iter_csv(rows, names)), mimetype='text/csv')
+    return Response(stream_with_context(search.iter_ndjson(rows, names)),
+                    mimetype='application/x-ndjson')
 
 @app.route('/visualize')
 def bokeh_plot():
+    from bokeh.embed import autoload_server
     bokeh_script=autoload_server(None,app_path="/visualize", url="http://rsfern.materials.cmu.edu")
     return render_template('visualize.html', bokeh_script=bokeh_script)
 
@@ -149,38 +548,40 @@ def bokeh_plot():
 def writeup():
     return redirect('https://arxiv.org/abs/1702.01117')
 
-def format_bib_entry(entry):
-    return markup
+PUBLICATION_FILES = (
+    'uhcsdb/static/documentation.bib',
+    'uhcsdb/static/sources.bib',
+    'uhcsdb/static/publications.bib'
+)
+_publications_page = {}
 
-def author_list(entry):
-    authors = [' '.join(p.last_names) for p in entry.persons['author']]
-    firstauthors, lastauthor = authors[:-1], authors[-1]
-    alist = ', '.join(firstauthors)
-    alist += ', and {}'.format(lastauthor)
-    return alist
+def clear_publications_page(changed=None):
+    _publications_page.clear()
 
-def load_publication_data(path):
-    """ use pybtex to display relevant publications """
-    pub_db = pybtex.database.parse_file(path)
-
-    publication_data = []
-    for key, entry in pub_db.entries.items():
-        pub = dict(entry.fields)
-        pub['authors'] = author_list(entry)
-        publication_data.append(pub)
-
-    return publication_data
+@app.before_first_request
+def watch_publications():
+    interval = app.config['PUBLICATIONS_WATCH_INTERVAL']
+    if interval:
+        bibliography.BibliographyWatcher(
+            PUBLICATION_FILES, interval=interval, on_change=clear_publications_page
+        ).start()
 
 @app.route('/publications')
 def publications():
+    version = bibliography.version(PUBLICATION_FILES)
+    if app.config['PUBLICATIONS_PRERENDER'] and version in _publications_page:
+        return _publications_page[version]
 
-    documentation = load_publication_data('uhcsdb/static/documentation.bib')
-    sources = load_publication_data('uhcsdb/static/sources.bib')
-    publications = load_publication_data('uhcsdb/static/publications.bib')
-    return render_template('publications.html',
+    documentation, sources, pubs = map(bibliography.load_publication_data, PUBLICATION_FILES)
+    page = render_template('publications.html',
                            documentation=documentation,
                            sources=sources,
-                           publications=publications)
+                           publications=pubs)
+
+    if app.config['PUBLICATIONS_PRERENDER']:
+        _publications_page.clear()
+        _publications_page[version] = page
+    return page
 
 
 
@@ -3,17 +3,26 @@ import sys
 import glob
 import h5py
 import numpy as np
-import pandas as pd
 import seaborn as sns
 import matplotlib as mpl
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, contains_eager
 
 from bokeh.layouts import row, widgetbox
 from bokeh.plotting import curdoc, figure
-from bokeh.models import Select, ColumnDataSource, HoverTool, OpenURL, TapTool
+from bokeh.models import Select, ColumnDataSource, HoverTool, OpenURL, Range1d, TapTool
 
-from models import Base, User, Collection, Sample, Micrograph
+from explorer_snapshot import load_snapshot
+from embedding_cache import embeddings
+
+# load all manifold methods for a representation as soon as it is selected
+PREFETCH_EMBEDDINGS = os.environ.get('UHCSDB_PREFETCH_EMBEDDINGS', '1') != '0'
+
+# level of detail: individual points (with thumbnails) are only sent to the
+# browser once at most POINT_BUDGET micrographs fall in the visible region;
+# wider views are drawn as an AGGREGATE_BINS x AGGREGATE_BINS density grid.
+POINT_BUDGET = int(os.environ.get('UHCSDB_EXPLORER_POINT_BUDGET', 5000))
+AGGREGATE_BINS = int(os.environ.get('UHCSDB_EXPLORER_BINS', 64))
+# coalesce the start/end updates of one pan or zoom into a single refresh
+RANGE_DEBOUNCE_MS = 150
 
 # only show micrographs with these class labels
 unique_labels = np.array(
@@ -58,6 +67,11 @@ hover = HoverTool(
 """
 )
 
+# density cells drawn when the view holds more than POINT_BUDGET micrographs
+bin_hover = HoverTool(
+    tooltips=[('micrographs', '@count'), ('mostly', '@mclass')]
+)
+
 
 def load_embedding(featuresfile, keys, method='PCA'):
     """ load reduced dimensionality map points from hdf5 into numpy array.
@@ -72,12 +86,25 @@ def load_embedding(featuresfile, keys, method='PCA'):
     return np.array(X)
 
 
-def connect_db(dbpath):
-    """return a sqlalchemy database connection."""
-    engine = create_engine('sqlite:///' + dbpath)
-    Base.metadata.bind = engine
-    dbSession = sessionmaker(bind=engine)
-    return dbSession()
+def embedding_key(hfile, method):
+    """ cache key: invalidated when the embedding file or the set of micrographs changes """
+    return (hfile, os.path.getmtime(hfile), method, micrograph_token)
+
+def embedding_loader(hfile, method):
+    return lambda: load_embedding(hfile, keys=data['micrograph_id'].astype(str), method=method)
+
+def cached_embedding(representation_file, method):
+    """ map points for a representation and manifold method, shared across sessions """
+    hfile = os.path.join('static', 'embed', representation_file)
+    return embeddings.get(embedding_key(hfile, method), embedding_loader(hfile, method))
+
+def prefetch_embeddings(representation_file):
+    """ warm the cache with every manifold method for a representation """
+    if not PREFETCH_EMBEDDINGS:
+        return
+    hfile = os.path.join('static', 'embed', representation_file)
+    embeddings.prefetch([(embedding_key(hfile, method), embedding_loader(hfile, method))
+                         for method in manifold_methods])
 
 
 def assign_color(colorvar):
@@ -107,29 +134,123 @@ def assign_scale(scalevar):
     return sc, alpha
 
 
+def data_extent(X, pad=0.05):
+    """ padded (xmin, xmax, ymin, ymax) bounding box of the map points """
+    lo, hi = np.nanmin(X, axis=0), np.nanmax(X, axis=0)
+    margin = pad * np.maximum(hi - lo, 1e-9)
+    lo, hi = lo - margin, hi + margin
+    return float(lo[0]), float(hi[0]), float(lo[1]), float(hi[1])
+
+def view_extent():
+    return p.x_range.start, p.x_range.end, p.y_range.start, p.y_range.end
+
+def visible_rows(extent):
+    x0, x1, y0, y1 = extent
+    return np.flatnonzero((embedding[:,0] >= x0) & (embedding[:,0] <= x1) &
+                          (embedding[:,1] >= y0) & (embedding[:,1] <= y1))
+
+def point_data(rows):
+    """ full per-point columns for a subset of micrographs """
+    return dict(
+        key=data['micrograph_id'][rows],
+        x=embedding[rows,0],
+        y=embedding[rows,1],
+        thumb=data['thumb'][rows].tolist(),
+        temperature=data['anneal_temperature'][rows],
+        time=data['anneal_time'][rows],
+        mclass=data['primary_microconstituent'][rows].tolist(),
+        mag=data['mag'][rows],
+        size=style['size'][rows],
+        c=style['c'][rows].tolist(),
+        alpha=style['alpha'][rows],
+    )
+
+def aggregate(rows, extent, n_bins=AGGREGATE_BINS):
+    """ density grid over the visible region.
+
+    each occupied cell carries its count and is colored by its most common
+    microconstituent, so the payload is bounded by n_bins**2 cells.
+    """
+    x0, x1, y0, y1 = extent
+    width, height = (x1 - x0) / n_bins, (y1 - y0) / n_bins
+    ix = np.clip(((embedding[rows,0] - x0) / width).astype(int), 0, n_bins - 1)
+    iy = np.clip(((embedding[rows,1] - y0) / height).astype(int), 0, n_bins - 1)
+    cell = ix * n_bins + iy
+
+    n_labels = label_names.size
+    by_label = np.bincount(cell * n_labels + label_codes[rows],
+                           minlength=n_bins * n_bins * n_labels).reshape(-1, n_labels)
+    counts = by_label.sum(axis=1)
+    occupied = np.flatnonzero(counts)
+    dominant = by_label[occupied].argmax(axis=1)
+    density = np.log1p(counts[occupied]) / np.log1p(max(counts.max(), 1))
+
+    return dict(
+        x=x0 + (occupied // n_bins + 0.5) * width,
+        y=y0 + (occupied % n_bins + 0.5) * height,
+        width=np.full(occupied.size, width),
+        height=np.full(occupied.size, height),
+        count=counts[occupied],
+        mclass=label_names[dominant].tolist(),
+        c=label_colors[dominant].tolist(),
+        alpha=0.25 + 0.65 * density,
+    )
+
+def refresh_view():
+    """ send points or density cells for the visible region, whichever fits the budget """
+    global refresh_pending
+    refresh_pending = False
+    extent = view_extent()
+    if any(v is None for v in extent):
+        extent = data_extent(embedding)
+    rows = visible_rows(extent)
+
+    if rows.size <= POINT_BUDGET:
+        source.data = point_data(rows)
+        bins.data = dict(empty_bins)
+    else:
+        source.data = point_data(rows[:0])
+        bins.data = aggregate(rows, extent)
+
+def schedule_refresh(attr, old, new):
+    global refresh_pending
+    if not refresh_pending:
+        refresh_pending = True
+        curdoc().add_timeout_callback(refresh_view, RANGE_DEBOUNCE_MS)
+
 def update_map_points(attr, old, new):
     """update plot data in response to bokeh widget form data."""
-        
-    hfile = os.path.join('static', 'embed', representation.value)
-    X = load_embedding(hfile, keys=df['micrograph_id'].astype(str), method=manifold.value)
-            
-    source.data['x'] = X[:,0]
-    source.data['y'] = X[:,1]
+    global embedding
+
+    if attr == 'value' and new in representations:
+        prefetch_embeddings(new)
+    embedding = cached_embedding(representation.value, manifold.value)
+
+    # zoom out to the new map, and have the reset tool return to it
+    # rather than to the first map's extent; the range callbacks
+    # schedule the refresh
+    x0, x1, y0, y1 = data_extent(embedding)
+    p.x_range.reset_start, p.x_range.reset_end = x0, x1
+    p.y_range.reset_start, p.y_range.reset_end = y0, y1
+    p.x_range.start, p.x_range.end = x0, x1
+    p.y_range.start, p.y_range.end = y0, y1
+    schedule_refresh(attr, old, new)
         
 def update_markercolor(attr, old, new):
     """update marker color metadata."""
     
     if markercolor.value == 'primary microconstituent':
-        col = [rgbmap[cls] for cls in df['primary_microconstituent']]
-        alpha = 0.8 * np.ones(df.index.size)
+        col = data['c']
+        alpha = 0.8 * np.ones(n_points)
     else:
         if markercolor.value == 'log(scale)':
-            col, alpha = assign_color(np.log(np.array(source.data['mag'])))
+            col, alpha = assign_color(np.log(np.array(data['mag'])))
         else:
-            col, alpha = assign_color(df[markercolor.value].values)
+            col, alpha = assign_color(data[markercolor.value])
 
-    source.data['c'] = col
-    source.data['alpha'] = alpha
+    style['c'] = np.asarray(col)
+    style['alpha'] = alpha
+    refresh_view()
 
     
 def update_markersize(attr, old, new):
@@ -137,34 +258,31 @@ def update_markersize(attr, old, new):
 
     # set sane defaults
     if markersize.value == 'None':
-        sz = 10*np.ones(df.index.size)
-        alpha = 0.8 * np.ones(df.index.size)
+        sz = 10*np.ones(n_points)
+        alpha = 0.8 * np.ones(n_points)
     else:
-        sz, alpha = assign_scale(df[markersize.value].values)
+        sz, alpha = assign_scale(data[markersize.value])
         
-    source.data['size'] = sz
-    source.data['alpha'] = alpha
+    style['size'] = sz
+    style['alpha'] = alpha
+    refresh_view()
     
 
-# load metadata for all micrographs into pandas dataframe
-db = connect_db('microstructures.sqlite')
-q = (db.query(Micrograph)
-     .outerjoin(Micrograph.sample)
-     .options(contains_eager(Micrograph.sample))
-     .filter(Micrograph.primary_microconstituent.in_(unique_labels)
-     )
-)
+# memory-map normalized metadata for all micrographs from the columnar snapshot
+data = load_snapshot('microstructures.sqlite', unique_labels, rgbmap)
+n_points = data['micrograph_id'].size
+micrograph_token = hash(data['micrograph_id'].tobytes())
 
-df = pd.read_sql_query(q.statement, con=db.connection())
+# microconstituent of each point as a small integer, for per-cell majority labels
+label_names, label_codes = np.unique(data['primary_microconstituent'], return_inverse=True)
+label_colors = np.array([rgbmap[label] for label in label_names])
 
-# Both Micrograph and Sample tables have an 'id' field...
-# loading the whole dataset into a pandas df yields two 'id' columns
-# drop the id field that results from Micrograph.sample.id
-# df = df.T.groupby(level=0).last().T
-df = df.replace(np.nan, -9999) # bokeh (because json) can't deal with NaN values
-
-# convert times to minutes, in place
-df.ix[df.anneal_time_unit=='H', 'anneal_time'] *= 60
+# marker styles for every micrograph; only the visible subset is sent to the browser
+style = dict(
+    size=10*np.ones(n_points),
+    c=np.asarray(data['c']),
+    alpha=0.8*np.ones(n_points),
+)
 
 # set default form data to draw the default plot
 default_representation = 'vgg16_block5_conv3-vlad-32.h5'                        
@@ -190,37 +308,36 @@ markercolor = Select(
 )
 markercolor.on_change('value', update_markercolor)
 
-hfile = os.path.join('static', 'embed', representation.value)
-x = load_embedding(hfile, keys=df['micrograph_id'].astype(str), method='t-SNE')
-
-thumb = ['static/thumbs/micrograph{}.png'.format(key) for key in df['micrograph_id']]
-
-source =  ColumnDataSource(
-    data=dict(
-        key=df['micrograph_id'].values,
-        x=x[:,0],
-        y=x[:,1],
-        thumb=thumb,
-        temperature=df['anneal_temperature'].values,
-        time=df['anneal_time'].values,
-        mclass=df['primary_microconstituent'].values,
-        mag=df['micron_bar'].values/df['micron_bar_px'].values, # TODO: convert units!
-        size=10*np.ones(df.index.size),
-        c = [rgbmap[cls] for cls in df['primary_microconstituent']],
-        alpha=0.8*np.ones(df.index.size),
-    )
-)
+embedding = cached_embedding(representation.value, manifold.value)
+prefetch_embeddings(representation.value)
+refresh_pending = False
 
+empty_bins = dict(x=[], y=[], width=[], height=[], count=[], mclass=[], c=[], alpha=[])
+source = ColumnDataSource(data=point_data(np.arange(0)))
+bins = ColumnDataSource(data=dict(empty_bins))
 
+# fixed ranges: an auto-ranging plot would follow whichever subset is loaded
+x0, x1, y0, y1 = data_extent(embedding)
 p = figure(plot_height=800, plot_width=800, title='UHCS microstructure explorer',
-           tools=['crosshair', 'pan', 'reset', 'save', 'wheel_zoom', 'tap', hover])
+           x_range=Range1d(x0, x1), y_range=Range1d(y0, y1),
+           tools=['crosshair', 'pan', 'reset', 'save', 'wheel_zoom', 'tap', hover, bin_hover])
+cells = p.rect(x='x', y='y', width='width', height='height', source=bins,
+               color='c', alpha='alpha', line_color=None)
 circles = p.circle(x='x', y='y', source=source, size='size', color='c', alpha='alpha', line_color="black", line_alpha=0.3)
+hover.renderers = [circles]
+bin_hover.renderers = [cells]
 p.toolbar.active_scroll = 'auto'
 
+for r in (p.x_range, p.y_range):
+    r.on_change('start', schedule_refresh)
+    r.on_change('end', schedule_refresh)
+refresh_view()
+
 # url_for_entry = "visual_query/@key"
 url_for_entry = "micrograph/@key"
 taptool = p.select(type=TapTool)
 taptool.callback = OpenURL(url=url_for_entry)
+taptool.renderers = [circles]
 
 controls = widgetbox([representation, manifold, markercolor, markersize], width=256)
 curdoc().add_root( row(controls, p) )